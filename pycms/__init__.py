@@ -20,13 +20,16 @@
 
 # Work started on 30. Sep 2013. This is a rewrite of BBk3 based on a different concept.
 
-import sys
 import os.path
 import json
 import shutil
-import glob
-import sys
 import re
+import hashlib
+import gzip
+import logging
+import time
+from pycms.registry import URIMap, SQLiteURIMap, TemplateRegistry, RoutingTable, write_file_atomic
+from pycms.metrics import METRICS
 
 VERSION = "0.1.0"
 
@@ -36,8 +39,61 @@ STATIC_FOLDER = "static"
 
 SPECIAL_FOLDERS = (TEMPLATES_FOLDER, STATIC_FOLDER)
 
+# Published generations of the site, and the symlink to the one being
+# served
+#
+GENERATIONS_FOLDER = "_generations"
+
+CURRENT_LINK = "_current"
+
+# Number of previous generations kept for rollback
+#
+GENERATIONS_KEPT = 3
+
+PAGE_FILE = "index.html"
+
+PAGE_META_FILE = "_page.json"
+
+URI_MAP_FILE = "_uri_template_map.json"
+
+TEMPLATE_INDEX_FILE = "_template_uri_map.json"
+
+URI_MAP_JOURNAL_FILE = "_uri_template_map.journal"
+
+URI_MAP_DATABASE_FILE = "_uri_template_map.sqlite"
+
+UPDATE_CHECKPOINT_FILE = "_update_checkpoint.journal"
+
 CONFIG_DICT = {}
 
+# Pages and static files of at least GZIP_MIN_SIZE bytes are stored
+# along with a gzip compressed copy, using GZIP_LEVEL. Set GZIP_LEVEL to
+# None to disable this.
+#
+GZIP_LEVEL = 6
+
+GZIP_MIN_SIZE = 1024
+
+# Static files with these extensions are compressed
+#
+GZIP_EXTENSIONS = (".html", ".htm", ".css", ".js", ".json", ".svg", ".txt", ".xml")
+
+# Number of pages handed to an update worker process at a time, and
+# recorded in the update checkpoint at a time
+#
+UPDATE_CHUNK_SIZE = 256
+
+# Default size of the rendered page cache of CMS in bytes
+#
+RENDER_CACHE_BYTES = 64 * 1024 * 1024
+
+# Seconds after which a server answering from a routing table picks up
+# changed pages
+#
+ROUTES_RELOAD_INTERVAL = 2.0
+
+LOGGER = logging.getLogger("pycms")
+
 class Instance:
     """Represents a hierarchy of pages, along with templates.
 
@@ -45,10 +101,35 @@ class Instance:
 
        Instance.htmlroot
            The path to this Instance's root directory.
+
+       Instance.uri_map
+           A pycms.URIMap or pycms.SQLiteURIMap, mapping the URIs of this
+           Instance's pages to their templates. An SQLite database is
+           used if one is present in `htmlroot`.
+
+       Instance.templates
+           A pycms.TemplateRegistry of the templates in `htmlroot`,
+           caching their hashes and placeholders, and telling which
+           templates have pending changes.
+
+       Instance.journal
+           Boolean flag whether the JSON URI map journals its changes.
+
+       Instance.fsync
+           Boolean flag whether changes to the URI map are flushed to
+           disk.
+
+       Instance.page_cache
+           The pycms.server.PageCache of a running server, or None.
+           Pages changed through this Instance are dropped from it.
     """
 
-    def __init__(self, htmlroot):
+    def __init__(self, htmlroot, journal = False, fsync = False):
         """Initialise. `htmlroot` is the path to this Instance's root directory.
+
+           If `journal` is True, changes to the URI map are appended to a
+           journal instead of rewriting the whole map. If `fsync` is True,
+           all writes to the URI map are flushed to disk.
         """
 
         self.htmlroot = htmlroot
@@ -59,6 +140,85 @@ class Instance:
             #
             self.htmlroot = htmlroot[:-1]
 
+        self.journal = journal
+
+        self.fsync = fsync
+
+        self.page_cache = None
+
+        if os.path.exists(os.path.join(self.htmlroot, URI_MAP_DATABASE_FILE)):
+
+            self.uri_map = self._open_uri_map("sqlite")
+
+        else:
+
+            self.uri_map = self._open_uri_map("json")
+
+        self.templates = TemplateRegistry(os.path.join(self.htmlroot, TEMPLATES_FOLDER), self.uri_map)
+
+        return
+
+    def _open_uri_map(self, backend):
+        """Return a URI map object for `backend`, which can be "json" or "sqlite".
+        """
+
+        if backend == "json":
+
+            return URIMap(os.path.join(self.htmlroot, URI_MAP_FILE),
+                          os.path.join(self.htmlroot, TEMPLATE_INDEX_FILE),
+                          os.path.join(self.htmlroot, URI_MAP_JOURNAL_FILE),
+                          journal = self.journal,
+                          fsync = self.fsync)
+
+        elif backend == "sqlite":
+
+            return SQLiteURIMap(os.path.join(self.htmlroot, URI_MAP_DATABASE_FILE),
+                                fsync = self.fsync)
+
+        raise RuntimeError('Unknown URI map backend "{}". Use "json" or "sqlite".'.format(backend))
+
+    def migrate_uri_map(self, backend):
+        """Move the URI map to `backend`, which can be "json" or "sqlite".
+        """
+
+        uri_map = self._open_uri_map(backend)
+
+        if uri_map.__class__ is self.uri_map.__class__:
+
+            return
+
+        # Discard any leftovers of an earlier migration
+        #
+        uri_map.remove_files()
+
+        uri_map.set_many(self.uri_map.items())
+
+        uri_map.save()
+
+        self.uri_map.remove_files()
+
+        self.uri_map = uri_map
+
+        self.templates.uri_map = uri_map
+
+        return
+
+    def _page_path(self, uri):
+        """Return the path to the index file of the page under `uri`.
+        """
+
+        return os.path.normpath(os.path.join(*[self.htmlroot] + uri.split("/") + [PAGE_FILE]))
+
+    def _invalidate(self, uris):
+        """Drop the pages under `uris` from the page cache of a running server.
+        """
+
+        if self.page_cache is not None:
+
+            for uri in uris:
+
+                self.page_cache.invalidate(self._page_path(uri))
+
         return
 
     def envinit(self):
@@ -67,11 +227,9 @@ class Instance:
 
         os.mkdir(self.htmlroot)
 
-        with open(os.path.join(self.htmlroot, "index.html"), "wt", encoding = "utf8") as htmlfile:
-
-            # TODO: This should actually be generated from the first template.
-            #
-            htmlfile.write('''<!DOCTYPE html>
+        # TODO: This should actually be generated from the first template.
+        #
+        _write_page(self.htmlroot, '''<!DOCTYPE html>
     <html>
     <meta charset="utf-8"/>
     <head>
@@ -84,7 +242,7 @@ class Instance:
         <p>Welcome to your pycms instance.</p>
     </body>
     </html>
-    ''')
+    '''.encode("utf8"))
 
         os.mkdir(os.path.join(self.htmlroot, TEMPLATES_FOLDER))
 
@@ -104,10 +262,7 @@ class Instance:
     </html>
     ''')
 
-        with open(os.path.join(self.htmlroot, "_uri_template_map.json"), "wt", encoding = "utf8") as mapfile:
-
-            mapfile.write(json.dumps({"/": "index_template.html"},
-                                     ensure_ascii = False))
+        self.uri_map["/"] = "index_template.html"
 
         os.mkdir(os.path.join(self.htmlroot, STATIC_FOLDER))
         
@@ -133,464 +288,1752 @@ class Instance:
         """Create and register a new page under the given URI using the given template.
         """
 
-        if not uri.startswith("/"):
+        self.create_pages([(uri, template)])
 
-            raise RuntimeError("The URI parameter must start with a slash.")
+        return
 
-        components = uri.strip("/").split("/")
+    def create_pages(self, pages):
+        """Create and register several new pages at once.
 
-        if components[0] in SPECIAL_FOLDERS:
+           `pages` is an iterable of (uri, template) or (uri, template,
+           content) tuples. If `content` is given, it is used as the
+           page's content instead of a copy of the template.
 
-            raise RuntimeError('"/{}/" is a special URI and can not be re-created.'.format(components[0]))
+           All URIs and templates are checked before anything is
+           written, so that either all pages or none are created. Each
+           template is read only once, and the URI map is saved only
+           once.
+        """
 
-        path = [self.htmlroot]
+        pages = list(pages)
 
-        path += components
+        # Look up each template once, rather than once per page
+        #
+        tokenised_templates = {}
 
-        path_with_index = path + ["index.html"]
-        
-        if uri == "/":
+        for page in pages:
 
-            if os.path.exists(os.path.join(*path_with_index)):
+            template = page[1]
 
-                raise RuntimeError('URI "{}" can not be created because "{}" already exists.'.format(uri, os.path.join(*path_with_index)))
+            if template not in tokenised_templates:
 
-        else:
+                try:
+                    tokenised_templates[template] = self.templates.tokenised(template)
 
-            if os.path.exists(os.path.join(*path)):
+                except KeyError:
 
-                raise RuntimeError('URI "{}" can not be created because "{}" already exists.'.format(uri, os.path.join(*path)))
+                    raise RuntimeError('URI "{}" can not be created because template "{}" does not exist.'.format(page[0], template))
 
-            os.makedirs(os.path.join(*path))
+        # Check all pages first
+        #
+        new_pages = []
 
-        shutil.copy(os.path.join(self.htmlroot, TEMPLATES_FOLDER, template), os.path.join(*path_with_index))
+        seen_uris = set()
 
-        uri_map_dict = {}
+        templates = {}
 
-        with open(os.path.join(self.htmlroot, "_uri_template_map.json"), "rt", encoding = "utf8") as uri_map_file:
+        for page in pages:
 
-            uri_map_dict = json.loads(uri_map_file.read())
+            uri, template = page[0], page[1]
 
-        uri_map_dict["/{}".format(uri.strip("/"))] = template
+            if not uri.startswith("/"):
 
-        with open(os.path.join(self.htmlroot, "_uri_template_map.json"), "wt", encoding = "utf8") as uri_map_file:
+                raise RuntimeError("The URI parameter must start with a slash.")
 
-            uri_map_file.write(json.dumps(uri_map_dict,
-                                          sort_keys = True,
-                                          ensure_ascii = False))
+            components = uri.strip("/").split("/")
 
-        return
-        
-    def edit_template(self, template):
-        """Create a backup of `template` in `htmlroot`, as a preparation for a template update.
-        """
+            if components[0] in SPECIAL_FOLDERS:
 
-        shutil.copy(os.path.join(self.htmlroot, TEMPLATES_FOLDER, template),
-                    os.path.join(self.htmlroot, TEMPLATES_FOLDER, template + ".old"))
+                raise RuntimeError('"/{}/" is a special URI and can not be re-created.'.format(components[0]))
 
-        return
+            for component in components:
 
-    def update(self):
-        """Search for pending template changes, apply them to all pages using the template and delete template backups.
-        """
+                if component.startswith(("_", ".")):
 
-        # Search for pending template changes
-        #
-        # NOTE: Not using os.path as glob uses Unix shell syntax
-        #
-        template_backups = glob.glob("/".join((self.htmlroot, TEMPLATES_FOLDER, "*.old")))
+                    raise RuntimeError('URI "{}" is invalid, as "{}" starts with an underscore or a dot.'.format(uri, component))
 
-        sys.stderr.write("template_backups == {}\n".format(template_backups))
+            normalised_uri = "/{}".format(uri.strip("/"))
 
-        # Apply them to all pages using the template.
-        # In passing, remove the path component.
-        #
-        changed_templates = [os.path.basename(path).rsplit(".old", 1)[0] for path in template_backups]
+            if normalised_uri in seen_uris:
 
-        sys.stderr.write("changed_templates == {}\n".format(changed_templates))
+                raise RuntimeError('URI "{}" is given more than once.'.format(uri))
 
-        uri_map_dict = {}
+            seen_uris.add(normalised_uri)
 
-        with open(os.path.join(self.htmlroot, "_uri_template_map.json"), "rt", encoding = "utf8") as uri_map_file:
+            path = os.path.join(*[self.htmlroot] + components)
 
-            uri_map_dict = json.loads(uri_map_file.read())
+            if uri == "/":
 
-        # We need a map from template to URIs
-        #
-        template_map_dict = {}
+                if os.path.exists(os.path.join(path, "index.html")):
+
+                    raise RuntimeError('URI "{}" can not be created because "{}" already exists.'.format(uri, os.path.join(path, "index.html")))
+
+            elif os.path.exists(path):
+
+                raise RuntimeError('URI "{}" can not be created because "{}" already exists.'.format(uri, path))
 
-        for uri in uri_map_dict.keys():
+            if len(page) > 2:
 
-            if uri_map_dict[uri] in template_map_dict.keys():
+                content = page[2].encode("utf8")
 
-                template_map_dict[uri_map_dict[uri]].append(uri)
+                fragments = self._fragments(template, page[2], tokenised = tokenised_templates[template])
 
             else:
 
-                template_map_dict[uri_map_dict[uri]] = [uri]
+                if template not in templates:
 
-        # For predictability, sort the URI lists
-        #
-        for template in template_map_dict.keys():
+                    with open(os.path.join(self.htmlroot, TEMPLATES_FOLDER, template), "rb") as template_file:
 
-            template_map_dict[template].sort()
+                        templates[template] = template_file.read()
 
-        sys.stderr.write("template_map_dict == {}\n".format(template_map_dict))
+                content = templates[template]
 
-        # There are two ways to do this: replay the template changes in
-        # all files that use the template, or replaying what each file
-        # changed in the original template to the new template. We'll go
-        # for the latter, as these changes should be less ambiguous.
+                # A copy of the template fills each placeholder with
+                # itself.
+                #
+                fragments = dict((placeholder, placeholder) for placeholder in tokenised_templates[template][1])
+
+            new_pages.append((normalised_uri, template, path, content, fragments))
+
+        # Create parents before children, so that each directory can
+        # be created with a single call.
         #
-        for template in changed_templates:
+        new_pages.sort(key = lambda new_page: new_page[2])
 
-            for uri in template_map_dict[template]:
+        created_directories = set()
 
-                sys.stderr.write("About to update '{}' using template '{}'\n".format(uri, template))
+        for normalised_uri, template, path, content, fragments in new_pages:
 
-                page_replacements = None
+            if normalised_uri != "/":
 
-                with open(os.path.join(self.htmlroot, TEMPLATES_FOLDER, template + ".old"), "rt", encoding = "utf8") as original_template:
+                if os.path.dirname(path) in created_directories:
 
-                    with open(os.path.join(*[self.htmlroot] + uri.split("/") + ["index.html"]), "rt", encoding = "utf8") as page:
+                    os.mkdir(path)
 
-                        # Diff from old template to page. This yields the
-                        # changes done to the template.
-                        #
-                        page_replacements = LineReplacement(original_template.read(),
-                                                            page.read())
+                else:
 
-                with open(os.path.join(self.htmlroot, TEMPLATES_FOLDER, template), "rt", encoding = "utf8") as new_template:
+                    os.makedirs(path)
 
-                    with open(os.path.join(*[self.htmlroot] + uri.split("/") + ["index.html"]), "wt", encoding = "utf8") as page:
+                created_directories.add(path)
 
-                        # Patch new template with diff. This replays the page's
-                        # edits using the new template, yielding an updated page.
-                        #
-                        page.write(page_replacements.replace(new_template.read()))
+            _write_page(path, content, fragments = fragments)
 
-            # Delete template backup
-            #
-            os.remove(os.path.join(self.htmlroot, TEMPLATES_FOLDER, template + ".old"))
+        self.uri_map.set_many([(new_page[0], new_page[1]) for new_page in new_pages])
+
+        self._invalidate([new_page[0] for new_page in new_pages])
 
         return
 
-    def remove_page(self, uri):
-        """Remove the page page under the given URI.
+    def write_page(self, uri, content):
+        """Replace the content of the existing page under `uri` with the string `content`.
         """
 
-        # TODO: Remove all pages starting with uri
+        normalised_uri = "/{}".format(uri.strip("/"))
 
-        if not uri.startswith("/"):
+        if normalised_uri not in self.uri_map:
 
-            raise RuntimeError("The URI parameter must start with a slash.")
+            raise RuntimeError('URI "{}" can not be written because it is not registered.'.format(uri))
 
-        if uri == "/":
+        _write_page(os.path.dirname(self._page_path(normalised_uri)),
+                    content.encode("utf8"),
+                    fragments = self._fragments(self.uri_map[normalised_uri], content))
 
-            # We do not want to remove the htmlroot directory.
-            # Remove the root index page only.
+        self._invalidate([normalised_uri])
 
-            os.remove(os.path.join(self.htmlroot, "index.html"))
+        return
 
-        else:
+    def _fragments(self, template, content, tokenised = None):
+        """Return a dict of the placeholder contents of `content`, a page using `template`, or None if they can not be told.
 
-            components = uri.strip("/").split("/")
+           `tokenised` is `template` as returned by
+           TemplateRegistry.tokenised(), if it has been looked up already.
+        """
 
-            if components[0] in SPECIAL_FOLDERS:
+        try:
+            if tokenised is None:
 
-                raise RuntimeError('"/{}/" is a special URI and can not be removed.'.format(components[0]))
+                tokenised = self.templates.tokenised(template)
 
-            path = [self.htmlroot]
+            return LineReplacement(None, content, tokenised = tokenised).replacements
 
-            path += components
+        except (RuntimeError, KeyError):
 
-            if not os.path.exists(os.path.join(*path)):
+            return None
 
-                raise RuntimeError('URI "{}" can not be removed because "{}" does not exist.'.format(uri, os.path.join(*path)))
+    def compress(self):
+        """(Re)build the gzip compressed copies of all pages and static files.
 
-            shutil.rmtree(os.path.join(*path))
+           Returns the number of files compressed.
+        """
 
-        uri_map_dict = {}
+        count = 0
 
-        with open(os.path.join(self.htmlroot, "_uri_template_map.json"), "rt", encoding = "utf8") as uri_map_file:
+        paths = [self._page_path(uri) for uri in self.uri_map.uris()]
 
-            uri_map_dict = json.loads(uri_map_file.read())
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.htmlroot, STATIC_FOLDER)):
 
-        del uri_map_dict["/{}".format(uri.strip("/"))]
+            paths.extend(os.path.join(dirpath, filename) for filename in filenames if filename.endswith(GZIP_EXTENSIONS))
 
-        with open(os.path.join(self.htmlroot, "_uri_template_map.json"), "wt", encoding = "utf8") as uri_map_file:
+        for path in paths:
 
-            uri_map_file.write(json.dumps(uri_map_dict,
-                                          sort_keys = True,
-                                          ensure_ascii = False))
+            try:
+                with open(path, "rb") as source_file:
 
-        return
-        
-    def serve(self, test = False):
-        """Serve the CMS instance from the root .
+                    data = source_file.read()
 
-           If test is set to True, the instance will terminate after a
-           short while. This is a feature for automated testing.
-        """
+            except FileNotFoundError:
 
-        # TODO: Move cherrypy code
-        #
-        # root = CMS(self.htmlroot)
-        #
-        # config_dict_final = {"/" : {"tools.sessions.on" : True,
-        #                            "tools.sessions.timeout" : 60}}
-        #
-        # config_dict_final.update(CONFIG_DICT)
+                continue
 
-        import http.server
-        import socketserver
+            _write_compressed(path, data)
 
-        # SimpleHTTPRequestHandler serves from the current directory,
-        # so change accordingly
+            if os.path.exists(path + ".gz"):
 
-        original_cwd = os.getcwd()
+                count += 1
 
-        try:
-            os.chdir(self.htmlroot)
+        return count
 
-        except FileNotFoundError:
-            
-            raise RuntimeError("Working environment directory 'pycmsroot' not found. Did you run pycms.envinit(\"pycmsroot\")?")
+    def edit_template(self, template):
+        """Create a backup of `template` in `htmlroot`, as a preparation for a template update.
+        """
 
-        handler = http.server.SimpleHTTPRequestHandler
+        shutil.copy(os.path.join(self.htmlroot, TEMPLATES_FOLDER, template),
+                    os.path.join(self.htmlroot, TEMPLATES_FOLDER, template + ".old"))
 
-        httpd = socketserver.TCPServer(("", 8000), handler)
+        return
 
-        exit_thread = None
+    def update(self, workers = 1, staged = False, subtree = None, priority = None):
+        """Search for pending template changes, apply them to all pages using the template and delete template backups.
 
-        if test:
+           Each template pair is read once. Pages whose new content is
+           identical to the current one, or which already match the new
+           template, are not rewritten, keeping their modification times.
+
+           If `workers` is greater than 1, the pages are patched in
+           parallel by that many worker processes.
+
+           A page that fails to update does not abort the run. Failures
+           are logged as warnings, and the backup of the respective
+           template is kept so that the update can be repeated once the
+           pages have been fixed.
+
+           Progress is recorded in UPDATE_CHECKPOINT_FILE after every
+           batch of pages, along with the hashes of the old and new
+           template. If an update is interrupted or leaves failed pages,
+           the next run for the same template pair skips the pages done
+           already. The checkpoint is removed once all changes have been
+           applied.
+
+           If `subtree` is given, only the pages at and below this URI
+           are updated. Template backups are kept until the pages
+           elsewhere have been updated by another run. `priority` is a
+           list of URIs to update first, in the given order, e.g. the
+           most requested pages.
+
+           If `staged` is True, the pages are published as a new
+           generation once all of them have been updated, see publish().
+           A run with failures is not published, so that the server
+           keeps serving the previous generation, consistently using the
+           old templates.
+
+           Returns a dict mapping the URIs of failed pages to error
+           messages.
+        """
 
-            sys.stderr.write("Testing enabled, terminating after timeout\n")
+        with METRICS.timer("update"):
 
-            def exit_after_timeout():
+            failures = self._update(workers, subtree, priority)
 
-                import time
+        if staged:
 
-                start_time = time.perf_counter()
+            if failures:
 
-                # Wait 2 seconds
-                #
-                while time.perf_counter() - start_time < 2.0:
+                LOGGER.warning("Not publishing a new generation due to failed pages")
 
-                    time.sleep(0.1)
+            else:
 
-                sys.stderr.write("About to terminate web server\n")
+                self.publish()
 
-                # NOTE: Terminate web server here
-                # cherrypy.engine.exit()
+        return failures
 
-                httpd.shutdown()
-                
-                return
+    def _update(self, workers, subtree, priority):
+        """Implementation of update().
+        """
 
-            import threading
+        # Backups identical to their template leave nothing to apply
+        #
+        for template in self.templates.unchanged():
 
-            exit_thread = threading.Thread(target = exit_after_timeout,
-                                           name = "exit_thread")
+            LOGGER.info("Template '%s' is unchanged, removing backup", template)
 
-            sys.stderr.write("Starting exit thread\n")
+            os.remove(os.path.join(self.htmlroot, TEMPLATES_FOLDER, template + ".old"))
 
-            exit_thread.start()
+        # Search for pending template changes, and apply them to all
+        # pages using the template.
+        #
+        changed_templates = self.templates.changed()
 
-        # NOTE: Start up web server here
-        # cherrypy.quickstart(root, config = config_dict_final)
+        LOGGER.debug("Changed templates: %s", changed_templates)
 
-        sys.stderr.write("Serving HTTP on port 8000\n")
-        
-        httpd.serve_forever()
+        METRICS.count("templates_changed", len(changed_templates))
 
-        os.chdir(original_cwd)
+        # The URI map maintains the reverse mapping from template to
+        # sorted URI lists.
+        #
+        template_map_dict = {}
 
-        if test:
+        for template in changed_templates:
 
-            sys.stderr.write("Waiting for exit thread\n")
+            template_map_dict[template] = self.uri_map.uris_for_template(template)
 
-            exit_thread.join()
+        LOGGER.debug("Pages using changed templates: %s", template_map_dict)
+
+        # There are two ways to do this: replay the template changes in
+        # all files that use the template, or replaying what each file
+        # changed in the original template to the new template. We'll go
+        # for the latter, as these changes should be less ambiguous.
+        #
+        # Read every template pair exactly once. Worker processes
+        # receive them when they are started.
+        #
+        sources = {}
 
-            sys.stderr.write("Exit thread joined\n")
+        for template in changed_templates:
 
-        return
+            with open(os.path.join(self.htmlroot, TEMPLATES_FOLDER, template + ".old"), "rt", encoding = "utf8") as original_template:
 
-class LineReplacement:
-    """Compute diffs and patches for multi-line strings where single lines have been replaced.
+                with open(os.path.join(self.htmlroot, TEMPLATES_FOLDER, template), "rt", encoding = "utf8") as new_template:
 
-       The lines being replaced must me unique in the source file.
-    """
+                    sources[template] = (original_template.read(), new_template.read())
 
-    def __init__(self, source, result):
-        """Initialise, and compute the replacements done to `source` in `result`.
-        
-           `source` and `result` are expected to be multi-line strings.
-        """
+        # A checkpoint only applies to the template pair it was
+        # recorded for
+        #
+        hashes = {}
 
-        source_split = source.splitlines(keepends = True)
+        for template in changed_templates:
 
-        result_split = result.splitlines(keepends = True)
+            hashes[template] = [hashlib.sha1(source.encode("utf8")).hexdigest() for source in sources[template]]
 
-        self.replacements = {}
+        checkpoint_path = os.path.join(self.htmlroot, UPDATE_CHECKPOINT_FILE)
 
-        # Okay I've been thinking about this for a while. Diffs and
-        # patches are by no means trivial. An especially in the case
-        # at hand it is easy to construct replacements that are
-        # ambiguous and very hard to parse.
-        #
-        # So, trying to be clever will only take us so far. Instead,
-        # what we do is go with a very naive way, using previous
-        # knowledge about the replacement pattern.
+        done = _read_update_checkpoint(checkpoint_path, hashes)
 
-        # Split the source at lines with single uppercase words
-        # + underscore, yielding a list of separator - token -
-        # separator ... successions
+        # Collect the pages left to update, in order
         #
-        tokenised = [[]]
+        pending = []
 
-        for line in source_split:
+        skipped = 0
 
-            if re.match("^[A-Z_]+$", line.strip()):
+        for template in changed_templates:
 
-                tokenised.append(line.strip())
+            for uri in template_map_dict[template]:
 
-                tokenised.append([])
+                if uri in done[template]:
 
-            else:
+                    skipped += 1
 
-                # NOTE: Expecting this to happen for the first line
-                #
-                tokenised[-1].append(line)
+                elif subtree is None or _in_subtree(uri, subtree):
 
-        if tokenised[-1] == []:
+                    pending.append((template, uri))
 
-            del tokenised[-1]
+        METRICS.count("pages_skipped", skipped)
 
-        while tokenised:
+        if skipped:
 
-            # Remove first separator in source and result, which should
-            # be common.
-            #
-            separator = tokenised[0]
+            LOGGER.info("Resuming update, skipping %s pages done already", skipped)
 
-            while separator:
+        if priority:
 
-                if separator[0] == result_split[0]:
+            ranks = {}
 
-                    del separator[0]
+            for rank, uri in enumerate(priority):
 
-                    del result_split[0]
+                ranks.setdefault("/{}".format(uri.strip("/")), rank)
 
-                else:
+            # The sort is stable, so the other pages keep their order
+            #
+            pending.sort(key = lambda item: ranks.get(item[1], len(ranks)))
 
-                    # TODO: This can only be recovered from when changing the *.old backup files. These should be deleted, i.e. editing the affected templates should probably be aborted.
-                    #
-                    raise RuntimeError("Source and result lines do not match when they should: '{}' vs. '{}'\n(Hint: The source line is not a valid placeholder, if that was intended.)".format(separator[0], result_split[0]))
+        # Batches of pages using the same template. They are the units
+        # of work for worker processes, and of checkpointing.
+        #
+        batches = []
 
-            # Remove the emptied list
-            #
-            del tokenised[0]
+        for template, uri in pending:
 
-            # Something left?
-            #
-            if tokenised:
+            if batches and batches[-1][0] == template and len(batches[-1][1]) < UPDATE_CHUNK_SIZE:
 
-                # Collect all lines after the line replacing the first token
-                # until the first match of the next separator is found.
-                # Note that this will easily yield false positives, as the
-                # separator pattern might be part of the replacement.
-                #
-                replacement = []
+                batches[-1][1].append(uri)
 
-                # NOTE: We expect this to terminate at some point, else it is no valid replacement anyway.
-                #
-                while tokenised[1][0] != result_split[0]:
+            else:
 
-                    replacement.append(result_split.pop(0))
+                batches.append((template, [uri]))
 
-                # Lines match now. Store replacement with enclosing
-                # whitespace removed, and repeat from removing the
-                # first separator.
-                #
-                self.replacements[tokenised[0]] = "".join(replacement).strip()
+        failures = {}
 
-                del tokenised[0]
+        if batches:
 
-        sys.stderr.write("Initialised with replacements = {}\n".format(self.replacements))
-        
-        return
+            with open(checkpoint_path, "at", encoding = "utf8") as checkpoint_file:
 
-    def replace(self, input):
-        """Replace occurences of LineReplacement.replacements keys in input with their respecitve values, and return the result.
-        """
+                def record(template, uris, batch_failures):
 
-        for key in self.replacements.keys():
+                    completed = [uri for uri in uris if uri not in batch_failures]
 
-            sys.stderr.write("Replacing '{}'\n".format(key))
-            
-            input = input.replace(key, self.replacements[key])
+                    done[template].update(completed)
 
-        return input
-        
-class CMS:
-    """CMS base class and root of a CherryPy site.
+                    failures.update(batch_failures)
 
-       Attributes:
+                    checkpoint_file.write(json.dumps({"template": template,
+                                                      "hashes": hashes[template],
+                                                      "done": completed}) + "\n")
 
-       CMS.htmlroot
-           A string, holding the root directory to serve from and save to.
-    """
+                    checkpoint_file.flush()
 
-    def __init__(self, htmlroot):
-        """Initialise.
-        """
+                    if self.fsync:
 
-        if not os.path.isdir(htmlroot):
+                        os.fsync(checkpoint_file.fileno())
 
-            raise RuntimeError("Working environment directory '{0}' not found. Did you run pycms.envinit(\"{0}\")?".format(htmlroot))
+                    return
 
-        self.htmlroot = htmlroot
+                if workers > 1:
 
-        self.exposed = True
+                    import concurrent.futures
 
-        return
+                    with concurrent.futures.ProcessPoolExecutor(max_workers = workers,
+                                                                initializer = _init_update_worker,
+                                                                initargs = (sources,)) as executor:
 
-    def __call__(self):
-        """Called by CherryPy to render this object.
+                        futures = [executor.submit(_update_shard, self.htmlroot, template, uris) for template, uris in batches]
+
+                        for future, batch in zip(futures, batches):
+
+                            batch_failures, batch_metrics = future.result()
+
+                            METRICS.merge(batch_metrics)
+
+                            record(batch[0], batch[1], batch_failures)
+
+                else:
+
+                    # Tokenise each old template once
+                    #
+                    tokenised = dict((template, LineReplacement.tokenise(sources[template][0])) for template in changed_templates)
+
+                    for template, uris in batches:
+
+                        record(template, uris, _update_pages(self.htmlroot,
+                                                             tokenised[template],
+                                                             sources[template][1],
+                                                             uris))
+
+        for template, uris in batches:
+
+            self._invalidate(uris)
+
+        METRICS.count("pages_failed", len(failures))
+
+        for uri in sorted(failures.keys()):
+
+            LOGGER.warning("Failed to update '%s': %s", uri, failures[uri])
+
+        incomplete_templates = []
+
+        for template in changed_templates:
+
+            if any(uri in failures for uri in template_map_dict[template]):
+
+                LOGGER.warning("Keeping backup of template '%s' due to failed pages", template)
+
+                incomplete_templates.append(template)
+
+            elif not done[template].issuperset(template_map_dict[template]):
+
+                LOGGER.info("Keeping backup of template '%s' until all pages are updated", template)
+
+                incomplete_templates.append(template)
+
+            else:
+
+                # Delete template backup
+                #
+                os.remove(os.path.join(self.htmlroot, TEMPLATES_FOLDER, template + ".old"))
+
+        # Keep the progress on incomplete templates only, one record
+        # each
+        #
+        if incomplete_templates:
+
+            write_file_atomic(checkpoint_path,
+                              "".join(json.dumps({"template": template,
+                                                  "hashes": hashes[template],
+                                                  "done": sorted(done[template])}) + "\n"
+                                      for template in incomplete_templates),
+                              fsync = self.fsync)
+
+        elif os.path.exists(checkpoint_path):
+
+            os.remove(checkpoint_path)
+
+        return failures
+
+    def generations(self):
+        """Return a sorted list of the numbers of the published generations.
+        """
+
+        try:
+            names = os.listdir(os.path.join(self.htmlroot, GENERATIONS_FOLDER))
+
+        except FileNotFoundError:
+
+            return []
+
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def current_generation(self):
+        """Return the number of the generation being served, or None if none has been published.
+        """
+
+        try:
+            return int(os.path.basename(os.readlink(os.path.join(self.htmlroot, CURRENT_LINK))))
+
+        except (OSError, ValueError):
+
+            return None
+
+    def publish(self):
+        """Publish the pages and static files as a new generation, and switch the server over to it.
+
+           The generation is built below GENERATIONS_FOLDER by
+           hard-linking the files of `htmlroot`, so that nothing is
+           copied. The CURRENT_LINK symlink is then replaced in a single
+           step. A server started after the first publication serves
+           from this link, and only ever sees complete generations.
+
+           Changes to the pages are not served until the next
+           publication. pycms replaces files instead of writing to them,
+           which leaves the linked files untouched. Files changed
+           otherwise, e.g. by an editor writing in place, must be
+           replaced as well.
+
+           The GENERATIONS_KEPT generations published before are kept
+           for rollback(), older ones are deleted.
+
+           Returns the number of the new generation.
+        """
+
+        generations = self.generations()
+
+        generation = 1
+
+        if generations:
+
+            generation = generations[-1] + 1
+
+        generations_path = os.path.join(self.htmlroot, GENERATIONS_FOLDER)
+
+        # Build under a temporary name, so that an interrupted run does
+        # not leave an incomplete generation behind
+        #
+        temp_path = os.path.join(generations_path, ".{}.tmp".format(generation))
+
+        if os.path.exists(temp_path):
+
+            shutil.rmtree(temp_path)
+
+        os.makedirs(temp_path)
+
+        with METRICS.timer("publish"):
+
+            linked = _link_tree(self.htmlroot, temp_path)
+
+            os.rename(temp_path, os.path.join(generations_path, str(generation)))
+
+            self._switch_generation(generation)
+
+        LOGGER.info("Published generation %s with %s files", generation, linked)
+
+        for old_generation in generations[:max(len(generations) - GENERATIONS_KEPT, 0)]:
+
+            LOGGER.debug("Removing generation %s", old_generation)
+
+            shutil.rmtree(os.path.join(generations_path, str(old_generation)))
+
+        return generation
+
+    def rollback(self):
+        """Switch the server back to the generation published before the one being served, and return its number.
+        """
+
+        current_generation = self.current_generation()
+
+        previous_generations = [generation for generation in self.generations()
+                                if current_generation is not None and generation < current_generation]
+
+        if not previous_generations:
+
+            raise RuntimeError("There is no previous generation to roll back to.")
+
+        self._switch_generation(previous_generations[-1])
+
+        LOGGER.info("Rolled back to generation %s", previous_generations[-1])
+
+        return previous_generations[-1]
+
+    def _switch_generation(self, generation):
+        """Point the CURRENT_LINK symlink to `generation`, replacing it in a single step.
+        """
+
+        link_path = os.path.join(self.htmlroot, CURRENT_LINK)
+
+        temp_path = "{}.{}.tmp".format(link_path, os.getpid())
+
+        if os.path.lexists(temp_path):
+
+            os.remove(temp_path)
+
+        # A relative link keeps working if `htmlroot` is moved
+        #
+        os.symlink(os.path.join(GENERATIONS_FOLDER, str(generation)), temp_path)
+
+        os.replace(temp_path, link_path)
+
+        return
+
+    def remove_page(self, uri, recursive = False):
+        """Remove the page page under the given URI.
+
+           If `recursive` is True, all pages below the URI are removed as
+           well, and unregistered from the map in one go. Otherwise, pages
+           below the URI are kept, and only the files of the page itself
+           are removed.
+
+           A URI that is not registered itself, but holds registered
+           pages below it, can only be removed recursively.
+        """
+
+        if not uri.startswith("/"):
+
+            raise RuntimeError("The URI parameter must start with a slash.")
+
+        normalised_uri = "/{}".format(uri.strip("/"))
+
+        if normalised_uri == "/":
+
+            # We do not want to remove the htmlroot directory.
+            # Remove the root index page only.
+            #
+            path = self.htmlroot
+
+        else:
+
+            components = uri.strip("/").split("/")
+
+            if components[0] in SPECIAL_FOLDERS:
+
+                raise RuntimeError('"/{}/" is a special URI and can not be removed.'.format(components[0]))
+
+            path = [self.htmlroot]
+
+            path += components
+
+            path = os.path.join(*path)
+
+            if not os.path.exists(path):
+
+                raise RuntimeError('URI "{}" can not be removed because "{}" does not exist.'.format(uri, path))
+
+        # Check everything before anything is removed from disk. The URI
+        # may be a mere directory holding registered pages, which can
+        # only be removed along with them.
+        #
+        registered = normalised_uri in self.uri_map
+
+        subpage_uris = [subpage_uri for subpage_uri in self.uri_map.subtree(normalised_uri) if subpage_uri != normalised_uri]
+
+        if not registered and not (recursive and subpage_uris):
+
+            raise RuntimeError('URI "{}" can not be removed because it is not registered.'.format(uri))
+
+        removed_uris = []
+
+        if registered:
+
+            removed_uris.append(normalised_uri)
+
+        if recursive:
+
+            if normalised_uri == "/":
+
+                if registered:
+
+                    os.remove(os.path.join(self.htmlroot, PAGE_FILE))
+
+                    _remove_page_files(self.htmlroot)
+
+                for name in set(subpage_uri.split("/")[1] for subpage_uri in subpage_uris):
+
+                    shutil.rmtree(os.path.join(self.htmlroot, name))
+
+            else:
+
+                shutil.rmtree(path)
+
+            removed_uris.extend(subpage_uris)
+
+        elif subpage_uris or normalised_uri == "/":
+
+            # Keep the directory, which holds the subpages
+            #
+            os.remove(os.path.join(path, PAGE_FILE))
+
+            _remove_page_files(path)
+
+        else:
+
+            shutil.rmtree(path)
+
+        self.uri_map.delete_many(removed_uris)
+
+        self._invalidate(removed_uris)
+
+        return
+        
+    def serve(self, test = False, host = None, port = None, threads = None, cache_bytes = None, cache_control = None, processes = None, metrics_path = None, render = None, preload = None):
+        """Serve the CMS instance from the root .
+
+           `host` and `port` give the address to listen on, `threads`
+           the number of worker threads handling connections, and
+           `cache_bytes` the size of the in-memory page cache, 0
+           disabling it. Defaults are taken from CONFIG_DICT["global"],
+           using the keys "server.socket_host", "server.socket_port",
+           "server.thread_pool" and "server.cache_bytes", and fall back
+           to all interfaces, port 8000, 10 threads and 64 MiB.
+
+           `cache_control` is a dict mapping URI path prefixes to
+           Cache-Control header values, defaulting to the
+           "server.cache_control" key and then to
+           pycms.server.CACHE_CONTROL.
+
+           If `processes` is greater than 1, that many worker processes
+           are forked to serve in parallel, each with `threads` threads
+           and its own page cache. Crashed workers are restarted. This
+           defaults to the "server.processes" key and then to 1.
+
+           `metrics_path` is a URI path under which the counters and
+           timers of pycms.METRICS are served, e.g. "/metrics". It
+           defaults to the "server.metrics_path" key, and metrics are not
+           served if neither is given. With several processes, each
+           request is answered with the metrics of the process handling
+           it.
+
+           If `render` is True, pages are rendered on request by a
+           pycms.CMS, so that template changes are served without
+           running update(). The rendered pages are cached in addition to
+           the page cache, with a budget of `cache_bytes` as well. This
+           defaults to the "server.render" key and then to False.
+
+           If `preload` is True, all pages are loaded into memory using
+           envparse() before serving, and answered from there. Changed
+           pages are re-read every ROUTES_RELOAD_INTERVAL seconds. This
+           defaults to the "server.preload" key and then to False, and
+           can not be combined with `render`.
+
+           Once a generation has been published, see publish(), the
+           server serves from the CURRENT_LINK symlink instead of from
+           `htmlroot`. The link is followed on every request, so that
+           publish() and rollback() take effect right away.
+
+           If test is set to True, the instance will terminate after a
+           short while. This is a feature for automated testing.
+        """
+
+        # TODO: Move cherrypy code
+        #
+        # root = CMS(self.htmlroot)
+        #
+        # config_dict_final = {"/" : {"tools.sessions.on" : True,
+        #                            "tools.sessions.timeout" : 60}}
+        #
+        # config_dict_final.update(CONFIG_DICT)
+
+        import pycms.server
+
+        global_config_dict = CONFIG_DICT.get("global", {})
+
+        if host is None:
+
+            host = global_config_dict.get("server.socket_host", "")
+
+        if port is None:
+
+            port = global_config_dict.get("server.socket_port", 8000)
+
+        if threads is None:
+
+            threads = global_config_dict.get("server.thread_pool", 10)
+
+        if cache_bytes is None:
+
+            cache_bytes = global_config_dict.get("server.cache_bytes", 64 * 1024 * 1024)
+
+        if cache_control is None:
+
+            cache_control = global_config_dict.get("server.cache_control")
+
+        if processes is None:
+
+            processes = global_config_dict.get("server.processes", 1)
+
+        if metrics_path is None:
+
+            metrics_path = global_config_dict.get("server.metrics_path")
+
+        if render is None:
+
+            render = global_config_dict.get("server.render", False)
+
+        if preload is None:
+
+            preload = global_config_dict.get("server.preload", False)
+
+        if render and preload:
+
+            raise RuntimeError("Pages can either be rendered on request or preloaded, not both.")
+
+        if not os.path.isdir(self.htmlroot):
+
+            raise RuntimeError("Working environment directory '{0}' not found. Did you run pycms.envinit(\"{0}\")?".format(self.htmlroot))
+
+        document_root = self.htmlroot
+
+        if os.path.islink(os.path.join(self.htmlroot, CURRENT_LINK)):
+
+            document_root = os.path.join(self.htmlroot, CURRENT_LINK)
+
+            if render:
+
+                raise RuntimeError("Pages can not be rendered on request once a generation has been published.")
+
+        if cache_bytes:
+
+            self.page_cache = pycms.server.PageCache(cache_bytes)
+
+        renderer = None
+
+        if render:
+
+            renderer = CMS(self.htmlroot, cache_bytes = cache_bytes, instance = self)
+
+        elif preload:
+
+            cms = CMS(self.htmlroot, cache_bytes = 0, instance = self)
+
+            LOGGER.info("Loaded %s pages", envparse(document_root, cms))
+
+            # Worker processes inherit the loaded table
+            #
+            renderer = cms.routes
+
+            renderer.reload_interval = ROUTES_RELOAD_INTERVAL
+
+        # The document root is handed to the server, so the process
+        # working directory stays untouched.
+        #
+        def create_server(listening_socket = None, reuse_port = False):
+
+            return pycms.server.ThreadPoolHTTPServer((host, port),
+                                                     pycms.server.PycmsHTTPRequestHandler,
+                                                     document_root,
+                                                     threads = threads,
+                                                     page_cache = self.page_cache,
+                                                     cache_control = cache_control,
+                                                     listening_socket = listening_socket,
+                                                     reuse_port = reuse_port,
+                                                     metrics_path = metrics_path or None,
+                                                     renderer = renderer)
+
+        if processes > 1:
+
+            # A database connection of the URI map, e.g. opened by
+            # envparse(), must not be shared by the workers. Each one
+            # opens its own on first use.
+            #
+            if isinstance(self.uri_map, SQLiteURIMap):
+
+                self.uri_map.close()
+
+            if test:
+
+                LOGGER.info("Testing enabled, terminating after timeout")
+
+            LOGGER.info("Serving HTTP on %s:%s with %s processes of %s threads", host or "*", port, processes, threads)
+
+            try:
+                pycms.server.serve_forked(create_server,
+                                          (host, port),
+                                          processes,
+                                          timeout = 2.0 if test else None)
+
+            finally:
+
+                self.page_cache = None
+
+            return
+
+        httpd = create_server()
+
+        exit_thread = None
+
+        if test:
+
+            LOGGER.info("Testing enabled, terminating after timeout")
+
+            def exit_after_timeout():
+
+                import time
+
+                start_time = time.perf_counter()
+
+                # Wait 2 seconds
+                #
+                while time.perf_counter() - start_time < 2.0:
+
+                    time.sleep(0.1)
+
+                LOGGER.debug("About to terminate web server")
+
+                # NOTE: Terminate web server here
+                # cherrypy.engine.exit()
+
+                httpd.shutdown()
+                
+                return
+
+            import threading
+
+            exit_thread = threading.Thread(target = exit_after_timeout,
+                                           name = "exit_thread")
+
+            LOGGER.debug("Starting exit thread")
+
+            exit_thread.start()
+
+        # NOTE: Start up web server here
+        # cherrypy.quickstart(root, config = config_dict_final)
+
+        LOGGER.info("Serving HTTP on %s:%s with %s threads", host or "*", port, threads)
+
+        try:
+            httpd.serve_forever()
+
+        finally:
+
+            httpd.server_close()
+
+            if self.page_cache is not None:
+
+                LOGGER.info("Page cache statistics: %s", self.page_cache.stats())
+
+                self.page_cache = None
+
+        if test:
+
+            LOGGER.debug("Waiting for exit thread")
+
+            exit_thread.join()
+
+            LOGGER.debug("Exit thread joined")
+
+        return
+
+def _write_page(directory, data, fragments = None):
+    """Write the bytes `data` as the page in `directory`, along with its metadata file.
+
+       `fragments` is a dict mapping the placeholders of the page's
+       template to the page's content for them, or None if not known.
+
+       Each file is replaced in a single step, so that a server reading
+       them never sees a partially written file, and so that published
+       generations hard-linking the old files are left untouched.
+    """
+
+    path = os.path.join(directory, PAGE_FILE)
+
+    write_file_atomic(path, data)
+
+    METRICS.count("bytes_written", len(data))
+
+    stat_result = os.stat(path)
+
+    _write_compressed(path, data)
+
+    # Record the content hash along with the file's signature, so
+    # readers can tell whether the page was edited since.
+    #
+    page_meta_dict = {"hash": hashlib.sha1(data).hexdigest(),
+                      "signature": [stat_result.st_mtime_ns, stat_result.st_size]}
+
+    if fragments is not None:
+
+        page_meta_dict["fragments"] = fragments
+
+    write_file_atomic(os.path.join(directory, PAGE_META_FILE),
+                      json.dumps(page_meta_dict,
+                                 sort_keys = True,
+                                 ensure_ascii = False))
+
+    return
+
+def _in_subtree(uri, subtree):
+    """Return True if `uri` is `subtree` or below it.
+    """
+
+    subtree = "/{}".format(subtree.strip("/"))
+
+    return subtree == "/" or uri == subtree or uri.startswith(subtree + "/")
+
+def _read_update_checkpoint(path, hashes):
+    """Return a dict mapping each template in `hashes` to a set of the URIs recorded as updated in the checkpoint file at `path`.
+
+       `hashes` maps template names to [old_hash, new_hash] lists.
+       Records for other template pairs are ignored.
+    """
+
+    done = dict((template, set()) for template in hashes.keys())
+
+    try:
+        with open(path, "rt", encoding = "utf8") as checkpoint_file:
+
+            for line in checkpoint_file:
+
+                try:
+                    checkpoint_record = json.loads(line)
+
+                except ValueError:
+
+                    # Torn by an interrupted write
+                    #
+                    continue
+
+                if hashes.get(checkpoint_record["template"]) == checkpoint_record["hashes"]:
+
+                    done[checkpoint_record["template"]].update(checkpoint_record["done"])
+
+    except FileNotFoundError:
+
+        pass
+
+    return done
+
+def _link_tree(source, target):
+    """Recreate the pages and static files below `source` in the existing directory `target`, hard-linking the files.
+
+       Names starting with an underscore or a dot are pycms internals
+       and left out, except for page metadata files, and so are
+       temporary files. Returns the number of files linked.
+    """
+
+    linked = 0
+
+    for entry in os.scandir(source):
+
+        if (entry.name.startswith(("_", ".")) and entry.name != PAGE_META_FILE) or entry.name.endswith(".tmp"):
+
+            continue
+
+        target_path = os.path.join(target, entry.name)
+
+        if entry.is_symlink():
+
+            os.symlink(os.readlink(entry.path), target_path)
+
+        elif entry.is_dir():
+
+            os.mkdir(target_path)
+
+            linked += _link_tree(entry.path, target_path)
+
+        elif entry.is_file():
+
+            try:
+                os.link(entry.path, target_path)
+
+            except OSError:
+
+                # The file system does not support hard links
+                #
+                shutil.copy2(entry.path, target_path)
+
+            linked += 1
+
+    return linked
+
+def _write_compressed(path, data):
+    """Write a gzip compressed copy of `data`, read from `path`, to `path` + ".gz", or remove a stale one.
+    """
+
+    if GZIP_LEVEL is not None and len(data) >= GZIP_MIN_SIZE:
+
+        # Leave out the time stamp, so that equal files yield equal
+        # compressed files.
+        #
+        write_file_atomic(path + ".gz", gzip.compress(data, compresslevel = GZIP_LEVEL, mtime = 0))
+
+    elif os.path.exists(path + ".gz"):
+
+        os.remove(path + ".gz")
+
+    return
+
+def _remove_page_files(directory):
+    """Remove the compressed copy and the metadata of the page in `directory`, if present.
+    """
+
+    for path in (os.path.join(directory, PAGE_FILE + ".gz"),
+                 os.path.join(directory, PAGE_META_FILE)):
+
+        if os.path.exists(path):
+
+            os.remove(path)
+
+    return
+
+def read_page_meta(directory):
+    """Return the metadata dict stored for the page in `directory`, or None if there is none.
+
+       The dict holds the SHA-1 hex digest of the page as "hash", and
+       [st_mtime_ns, st_size] of the page file as "signature". If known,
+       "fragments" maps the placeholders of the page's template to the
+       page's content for them.
+    """
+
+    try:
+        with open(os.path.join(directory, PAGE_META_FILE), "rt", encoding = "utf8") as page_meta_file:
+
+            return json.loads(page_meta_file.read())
+
+    except (FileNotFoundError, ValueError):
+
+        return None
+
+# Worker state for Instance.update(). Maps template names to
+# (tokenised_old_source, new_source) tuples.
+#
+_WORKER_SOURCES = {}
+
+def _init_update_worker(sources):
+    """Initialise an update worker process with the template sources to apply.
+    """
+
+    # Drop the metrics inherited from the parent process
+    #
+    METRICS.reset()
+
+    for template in sources.keys():
+
+        # Tokenise each old template once per worker
+        #
+        _WORKER_SOURCES[template] = (LineReplacement.tokenise(sources[template][0]),
+                                     sources[template][1])
+
+    return
+
+def _update_shard(htmlroot, template, uris):
+    """Worker entry point: update the pages under `uris` from `template`, using the sources handed over at worker start.
+
+       Returns a tuple (failures, metrics), `metrics` being a snapshot
+       of the metrics recorded for this shard.
+    """
+
+    failures = _update_pages(htmlroot,
+                             _WORKER_SOURCES[template][0],
+                             _WORKER_SOURCES[template][1],
+                             uris)
+
+    metrics = METRICS.snapshot()
+
+    METRICS.reset()
+
+    return (failures, metrics)
+
+def _update_pages(htmlroot, tokenised, new_source, uris):
+    """Replay the edits each page under `uris` made to an old template onto `new_source`, and rewrite the page if it changed.
+
+       `tokenised` is the old template, as returned by
+       LineReplacement.tokenise().
+
+       The placeholder contents stored in a page's metadata are used if
+       the page has not been changed since it was written, as told by
+       its signature or content hash. Otherwise, they are recovered by
+       diffing the page against the old template.
+
+       Returns a dict mapping the URIs of failed pages to error messages.
+    """
+
+    failures = {}
+
+    # All pages of a template replace the same placeholders
+    #
+    compiled = LineReplacement.compile(new_source, tokenised[1])
+
+    # Phase durations are summed up locally, and recorded once
+    #
+    durations = {"update_read": 0.0, "update_diff": 0.0, "update_patch": 0.0, "update_write": 0.0}
+
+    bytes_read = 0
+
+    unchanged = 0
+
+    # Pages rendered from their stored placeholder contents, and pages
+    # diffed against the old template
+    #
+    rendered = 0
+
+    diffed = 0
+
+    # The new template is only tokenised if a page does not match the
+    # old one
+    #
+    new_tokenised = None
+
+    for uri in uris:
+
+        LOGGER.debug("About to update '%s'", uri)
+
+        directory = os.path.join(*[htmlroot] + uri.split("/"))
+
+        try:
+            start_time = time.perf_counter()
+
+            page_path = os.path.join(directory, PAGE_FILE)
+
+            data = None
+
+            # Use the placeholder contents stored along with the page,
+            # unless the page has been edited since it was written.
+            #
+            page_meta_dict = read_page_meta(directory)
+
+            fragments = None
+
+            if page_meta_dict is not None:
+
+                fragments = page_meta_dict.get("fragments")
+
+            if fragments is not None and set(fragments.keys()) == set(tokenised[1]):
+
+                stat_result = os.stat(page_path)
+
+                if page_meta_dict["signature"] != [stat_result.st_mtime_ns, stat_result.st_size]:
+
+                    # Modified or copied. Only the content tells.
+                    #
+                    with open(page_path, "rb") as page:
+
+                        data = page.read()
+
+                    bytes_read += len(data)
+
+                    if hashlib.sha1(data).hexdigest() != page_meta_dict["hash"]:
+
+                        fragments = None
+
+            else:
+
+                fragments = None
+
+            if fragments is None and data is None:
+
+                with open(page_path, "rb") as page:
+
+                    data = page.read()
+
+                bytes_read += len(data)
+
+            phase_time = time.perf_counter()
+
+            durations["update_read"] += phase_time - start_time
+
+            start_time = phase_time
+
+            if fragments is None:
+
+                # Diff from old template to page. This yields the
+                # changes done to the template.
+                #
+                diffed += 1
+
+                try:
+                    fragments = LineReplacement(None, data.decode("utf8"), tokenised = tokenised).replacements
+
+                except RuntimeError as error:
+
+                    # The page may have been updated by an earlier run
+                    # already, which failed for other pages.
+                    #
+                    if new_tokenised is None:
+
+                        new_tokenised = LineReplacement.tokenise(new_source)
+
+                    try:
+                        LineReplacement(None, data.decode("utf8"), tokenised = new_tokenised)
+
+                    except RuntimeError:
+
+                        raise error
+
+                    durations["update_diff"] += time.perf_counter() - start_time
+
+                    unchanged += 1
+
+                    continue
+
+                phase_time = time.perf_counter()
+
+                durations["update_diff"] += phase_time - start_time
+
+                start_time = phase_time
+
+            else:
+
+                rendered += 1
+
+            # Patch new template with the placeholder contents. This
+            # replays the page's edits using the new template, yielding
+            # an updated page.
+            #
+            new_data = LineReplacement.from_replacements(fragments).replace(new_source, compiled = compiled).encode("utf8")
+
+            phase_time = time.perf_counter()
+
+            durations["update_patch"] += phase_time - start_time
+
+            start_time = phase_time
+
+            # Leave pages that come out the same untouched, so that
+            # their modification times and ETags stay valid. If the
+            # current content has been read, comparing it is cheaper
+            # than hashing.
+            #
+            if data is not None:
+
+                if new_data == data:
+
+                    unchanged += 1
+
+                    continue
+
+            elif hashlib.sha1(new_data).hexdigest() == page_meta_dict["hash"]:
+
+                unchanged += 1
+
+                continue
+
+            _write_page(directory, new_data, fragments = fragments)
+
+            durations["update_write"] += time.perf_counter() - start_time
+
+        except Exception as error:
+
+            failures[uri] = "{}: {}".format(error.__class__.__name__, error)
+
+    for name in durations.keys():
+
+        METRICS.observe(name, durations[name])
+
+    METRICS.count("pages_diffed", diffed)
+
+    METRICS.count("pages_rendered", rendered)
+
+    METRICS.count("pages_updated", len(uris) - len(failures) - unchanged)
+
+    METRICS.count("pages_unchanged", unchanged)
+
+    METRICS.count("bytes_read", bytes_read)
+
+    return failures
+
+class LineReplacement:
+    """Compute diffs and patches for multi-line strings where single lines have been replaced.
+
+       The lines being replaced must me unique in the source file.
+    """
+
+    # Placeholder lines consist of a single word of uppercase letters
+    # and underscores.
+    #
+    PLACEHOLDER_RE = re.compile("^[A-Z_]+$")
+
+    def __init__(self, source, result, tokenised = None):
+        """Initialise, and compute the replacements done to `source` in `result`.
+        
+           `source` and `result` are expected to be multi-line strings.
+
+           `tokenised` may be the result of LineReplacement.tokenise(source).
+           When comparing many results to the same source, pass it in to
+           tokenise the source only once.
         """
 
-        return "Hello World!"
+        if tokenised is None:
 
-def envparse(htmlroot, cms_instance):
-    """Parse the working environment in directory 'htmlroot', and populate the CMS instance 'cms_instance' with the results.
+            tokenised = LineReplacement.tokenise(source)
+
+        separators, placeholders = tokenised
+
+        result_split = result.splitlines(keepends = True)
+
+        self.replacements = {}
+
+        # Okay I've been thinking about this for a while. Diffs and
+        # patches are by no means trivial. An especially in the case
+        # at hand it is easy to construct replacements that are
+        # ambiguous and very hard to parse.
+        #
+        # So, trying to be clever will only take us so far. Instead,
+        # what we do is go with a very naive way, using previous
+        # knowledge about the replacement pattern.
+        #
+        # We walk through the result exactly once, using `position`
+        # as a cursor.
+        #
+        position = 0
+
+        result_length = len(result_split)
+
+        for index, separator in enumerate(separators):
+
+            # Skip the separator in source and result, which should be
+            # common.
+            #
+            for line in separator:
+
+                if position == result_length or line != result_split[position]:
+
+                    # TODO: This can only be recovered from when changing the *.old backup files. These should be deleted, i.e. editing the affected templates should probably be aborted.
+                    #
+                    raise RuntimeError("Source and result lines do not match when they should: '{}' vs. '{}'\n(Hint: The source line is not a valid placeholder, if that was intended.)".format(line, result_split[position] if position < result_length else ""))
+
+                position += 1
+
+            # Something left?
+            #
+            if index < len(placeholders):
+
+                start = position
+
+                next_separator = separators[index + 1]
+
+                if next_separator:
+
+                    # Collect all lines after the line replacing the
+                    # token until the first match of the next separator
+                    # is found. Note that this will easily yield false
+                    # positives, as the separator pattern might be part
+                    # of the replacement.
+                    #
+                    while position < result_length and result_split[position] != next_separator[0]:
+
+                        position += 1
+
+                    if position == result_length:
+
+                        raise RuntimeError("The line following placeholder '{}' was not found: '{}'".format(placeholders[index], next_separator[0]))
+
+                elif index + 1 == len(placeholders):
+
+                    # The source ends with this placeholder, which hence
+                    # takes the remainder of the result.
+                    #
+                    position = result_length
+
+                else:
+
+                    raise RuntimeError("Placeholders '{}' and '{}' must be separated by at least one line.".format(placeholders[index], placeholders[index + 1]))
+
+                # Store replacement with enclosing whitespace removed
+                #
+                self.replacements[placeholders[index]] = "".join(result_split[start:position]).strip()
+
+        LOGGER.debug("Initialised with replacements = %s", self.replacements)
+        
+        return
+
+    @classmethod
+    def from_replacements(cls, replacements):
+        """Return a LineReplacement for a dict of known `replacements`, without computing a diff.
+        """
+
+        line_replacement = cls.__new__(cls)
+
+        line_replacement.replacements = replacements
+
+        return line_replacement
+
+    @staticmethod
+    def tokenise(source):
+        """Split `source` at placeholder lines.
+
+           Returns a tuple (separators, placeholders). `placeholders` is a
+           tuple of placeholder names, `separators` a tuple of tuples of
+           the lines around them, holding one item more than
+           `placeholders`.
+        """
+
+        # Split the source at lines with single uppercase words
+        # + underscore, yielding a list of separator - token -
+        # separator ... successions
+        #
+        separators = [[]]
+
+        placeholders = []
+
+        for line in source.splitlines(keepends = True):
+
+            stripped_line = line.strip()
+
+            if LineReplacement.PLACEHOLDER_RE.match(stripped_line):
+
+                placeholders.append(stripped_line)
+
+                separators.append([])
+
+            else:
+
+                # NOTE: Expecting this to happen for the first line
+                #
+                separators[-1].append(line)
+
+        return (tuple(tuple(separator) for separator in separators),
+                tuple(placeholders))
+
+    def replace(self, input, compiled = None):
+        """Replace occurences of LineReplacement.replacements keys in input with their respecitve values, and return the result.
+
+           The input is scanned only once, so replacement values are
+           never subject to further replacements. Where keys overlap,
+           the longest one wins.
+
+           `compiled` may be the result of LineReplacement.compile(input,
+           keys), where `keys` includes all keys of this
+           LineReplacement. When applying many LineReplacements to the
+           same input, pass it in to compile the input only once.
+        """
+
+        if compiled is None:
+
+            compiled = LineReplacement.compile(input, self.replacements.keys())
+
+        if LOGGER.isEnabledFor(logging.DEBUG):
+
+            LOGGER.debug("Replacing %s", list(self.replacements.keys()))
+
+        segments = list(compiled)
+
+        # Keys are at the odd indices. Keys without a replacement
+        # stay as they are.
+        #
+        segments[1::2] = [self.replacements.get(key, key) for key in compiled[1::2]]
+
+        return "".join(segments)
+
+    @staticmethod
+    def compile(input, keys):
+        """Split `input` at all occurences of `keys`, for use with LineReplacement.replace().
+
+           Returns a tuple alternating between literal text and keys,
+           starting and ending with literal text.
+        """
+
+        if not keys:
+
+            return (input,)
+
+        # Try longer keys first, so that a key which is part of another
+        # one does not shadow it.
+        #
+        pattern = re.compile("({})".format("|".join(re.escape(key) for key in sorted(keys, key = len, reverse = True))))
+
+        return tuple(pattern.split(input))
+
+class CMS:
+    """Renders the pages of a pycms instance on request, from their templates and the placeholder contents stored with each page.
+
+       Serving through a CMS, a template change takes effect with the
+       next request for a page using it, without Instance.update()
+       rewriting the page files. The content hash of a template serves
+       as its version, and the compiled template is cached along with
+       it. Rendered pages are held in a cache bounded by a byte budget,
+       keyed by URI and valid for one template version and one version
+       of the page.
+
+       Pages are rendered as Instance.update() would write them. Pages
+       without stored placeholder contents, and pages edited on disk
+       since they were written, are not rendered. They are served as
+       stored until the next update.
+
+       Attributes:
+
+       CMS.htmlroot
+           A string, holding the root directory to serve from and save to.
+
+       CMS.uri_map
+           The URI map of the instance.
+
+       CMS.templates
+           The pycms.TemplateRegistry of the instance.
+
+       CMS.render_cache
+           A pycms.server.PageCache for rendered pages, or None.
+
+       CMS.routes
+           The pycms.RoutingTable filled by envparse(), or None.
     """
 
-    # TODO: This is a demo, catching only the index page. Replace with tree parser.
-    # TODO: parse URI template mapping
+    def __init__(self, htmlroot, cache_bytes = RENDER_CACHE_BYTES, instance = None):
+        """Initialise. `cache_bytes` is the size of the rendered page cache, 0 disabling it.
 
-    page_content = None
+           If `instance` is given, its URI map and template registry are
+           shared. Otherwise, an Instance for `htmlroot` is opened.
+        """
 
-    with open(os.path.join(htmlroot, "index.html"), "rt", encoding = "utf8") as page_file:
+        if not os.path.isdir(htmlroot):
 
-        page_content = page_file.read()
+            raise RuntimeError("Working environment directory '{0}' not found. Did you run pycms.envinit(\"{0}\")?".format(htmlroot))
 
-    # Hand the string over at function definition time, which stores a
-    # reference to the current value. Using the variable at execution
-    # time would point to the value present then.
-    #
-    def return_page(self, return_value = page_content):
+        if instance is None:
 
-        return return_value
+            instance = Instance(htmlroot)
 
-    # Expose for CherryPy
-    #
-    return_page.exposed = True
+        self.htmlroot = instance.htmlroot
 
-    # "Instances of arbitrary classes can be made callable by defining
-    # a __call__() method in their class."
-    # python-docs-3.3.0/html/reference/datamodel.html#types
-    #
-    cms_instance.__class__.__call__ = return_page
+        self.uri_map = instance.uri_map
 
-    return
+        self.templates = instance.templates
+
+        self.render_cache = None
+
+        if cache_bytes:
+
+            import pycms.server
+
+            self.render_cache = pycms.server.PageCache(cache_bytes)
+
+        self.routes = None
+
+        self.exposed = True
+
+        return
+
+    def render(self, uri, encoding = None):
+        """Return a tuple (body, etag, mtime, encoding) for the page under `uri`, rendered from its template, or None if it can not be rendered.
+
+           `etag` is an entity tag without the quotes, and `mtime` the
+           later modification time of the page and its template, in
+           seconds. If `encoding` is "gzip", the body is compressed
+           unless it is too small to benefit, and the encoding of the
+           body is returned.
+        """
+
+        template = self.uri_map.get(uri)
+
+        if template is None:
+
+            return None
+
+        directory = os.path.join(*[self.htmlroot] + uri.split("/"))
+
+        try:
+            page_meta_stat_result = os.stat(os.path.join(directory, PAGE_META_FILE))
+
+            page_stat_result = os.stat(os.path.join(directory, PAGE_FILE))
+
+            version, template_mtime_ns, compiled = self.templates.compiled(template)
+
+        except (OSError, KeyError):
+
+            return None
+
+        # A new template version, new placeholder contents or an edit of
+        # the page file all change the signature.
+        #
+        signature = (version,
+                     page_meta_stat_result.st_ino,
+                     page_meta_stat_result.st_mtime_ns,
+                     page_meta_stat_result.st_size,
+                     page_stat_result.st_mtime_ns,
+                     page_stat_result.st_size)
+
+        key = (uri, encoding)
+
+        if self.render_cache is not None:
+
+            cached = self.render_cache.get(key, signature)
+
+            if cached is not None:
+
+                return (cached[0],) + cached[1]
+
+        page_meta_dict = read_page_meta(directory)
+
+        if (page_meta_dict is None
+            or page_meta_dict.get("fragments") is None
+            or page_meta_dict["signature"] != [page_stat_result.st_mtime_ns, page_stat_result.st_size]):
+
+            return None
+
+        with METRICS.timer("render"):
+
+            body = LineReplacement.from_replacements(page_meta_dict["fragments"]).replace(None, compiled = compiled).encode("utf8")
+
+            etag = hashlib.sha1(body).hexdigest()
+
+            if encoding == "gzip" and GZIP_LEVEL is not None and len(body) >= GZIP_MIN_SIZE:
+
+                body = gzip.compress(body, compresslevel = GZIP_LEVEL, mtime = 0)
+
+                etag = etag + "-gzip"
+
+            else:
+
+                encoding = None
+
+        mtime = max(page_meta_stat_result.st_mtime_ns, template_mtime_ns) / 1e9
+
+        if self.render_cache is not None:
+
+            self.render_cache.put(key, signature, body, (etag, mtime, encoding))
+
+        return (body, etag, mtime, encoding)
+
+    def __call__(self, uri = "/"):
+        """Return the page under `uri` as a string, from the routing table filled by envparse().
+        """
+
+        if self.routes is None:
+
+            raise RuntimeError("No pages loaded for '{0}'. Did you run pycms.envparse(\"{0}\", cms_instance)?".format(self.htmlroot))
+
+        route = self.routes.get(uri)
+
+        if route is None:
+
+            raise RuntimeError('URI "{}" is not registered.'.format(uri))
+
+        return route[1].decode("utf8")
+
+def envparse(htmlroot, cms_instance):
+    """Parse the working environment in directory 'htmlroot', and populate the CMS instance 'cms_instance' with the results.
+
+       All registered pages are loaded into `cms_instance.routes`, a
+       pycms.RoutingTable. If the CMS instance has been populated
+       before, only the page files changed since are read again.
+
+       Returns the number of page files read.
+    """
+
+    if cms_instance.routes is None:
+
+        cms_instance.routes = RoutingTable(htmlroot, cms_instance.uri_map)
+
+    return cms_instance.routes.reload()
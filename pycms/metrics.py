@@ -0,0 +1,203 @@
+"""Counters and timers for instrumenting pycms.
+
+   Copyright (c) 2013 Florian Berger <fberger@florian-berger.de>
+"""
+
+# This file is part of pycms.
+#
+# pycms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pycms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pycms.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import json
+
+class Metrics:
+    """A thread safe collection of named counters and timers.
+
+       Counters are plain numbers that only go up. Timers record the
+       number of observations, and their sum and maximum in seconds.
+
+       Metrics are kept per process. Worker processes return snapshots
+       of their own metrics, which are merged into those of the parent.
+    """
+
+    def __init__(self):
+        """Initialise with no metrics recorded.
+        """
+
+        self._lock = threading.Lock()
+
+        self._counters = {}
+
+        # Timer name -> [count, sum, max]
+        #
+        self._timers = {}
+
+        return
+
+    def count(self, name, value = 1):
+        """Add `value` to the counter `name`.
+        """
+
+        with self._lock:
+
+            self._counters[name] = self._counters.get(name, 0) + value
+
+        return
+
+    def observe(self, name, seconds):
+        """Record a duration of `seconds` with the timer `name`.
+        """
+
+        with self._lock:
+
+            timer = self._timers.get(name)
+
+            if timer is None:
+
+                timer = self._timers[name] = [0, 0.0, 0.0]
+
+            timer[0] += 1
+
+            timer[1] += seconds
+
+            if seconds > timer[2]:
+
+                timer[2] = seconds
+
+        return
+
+    def timer(self, name):
+        """Return a context manager recording the duration of its block with the timer `name`.
+        """
+
+        return Timer(self, name)
+
+    def snapshot(self):
+        """Return a dict with the keys "counters" and "timers", holding copies of all metrics.
+
+           Timers are given as dicts with the keys "count", "sum" and
+           "max".
+        """
+
+        with self._lock:
+
+            return {"counters": dict(self._counters),
+                    "timers": dict((name, {"count": timer[0], "sum": timer[1], "max": timer[2]})
+                                   for name, timer in self._timers.items())}
+
+    def merge(self, snapshot):
+        """Add the metrics from `snapshot`, as returned by snapshot(), to these.
+        """
+
+        with self._lock:
+
+            for name, value in snapshot["counters"].items():
+
+                self._counters[name] = self._counters.get(name, 0) + value
+
+            for name, other in snapshot["timers"].items():
+
+                timer = self._timers.get(name)
+
+                if timer is None:
+
+                    timer = self._timers[name] = [0, 0.0, 0.0]
+
+                timer[0] += other["count"]
+
+                timer[1] += other["sum"]
+
+                timer[2] = max(timer[2], other["max"])
+
+        return
+
+    def reset(self):
+        """Discard all metrics.
+        """
+
+        with self._lock:
+
+            self._counters = {}
+
+            self._timers = {}
+
+        return
+
+    def to_json(self):
+        """Return all metrics as a JSON string.
+        """
+
+        return json.dumps(self.snapshot(), sort_keys = True)
+
+    def to_text(self, prefix = "pycms_"):
+        """Return all metrics in the Prometheus text exposition format.
+
+           Counters are exported as `<prefix><name>_total`, timers as
+           `<prefix><name>_seconds_count`, `_sum` and `_max`.
+        """
+
+        snapshot = self.snapshot()
+
+        lines = []
+
+        for name in sorted(snapshot["counters"].keys()):
+
+            lines.append("# TYPE {}{}_total counter".format(prefix, name))
+
+            lines.append("{}{}_total {}".format(prefix, name, snapshot["counters"][name]))
+
+        for name in sorted(snapshot["timers"].keys()):
+
+            timer = snapshot["timers"][name]
+
+            lines.append("# TYPE {}{}_seconds summary".format(prefix, name))
+
+            lines.append("{}{}_seconds_count {}".format(prefix, name, timer["count"]))
+
+            lines.append("{}{}_seconds_sum {:.6f}".format(prefix, name, timer["sum"]))
+
+            lines.append("# TYPE {}{}_seconds_max gauge".format(prefix, name))
+
+            lines.append("{}{}_seconds_max {:.6f}".format(prefix, name, timer["max"]))
+
+        return "".join(line + "\n" for line in lines)
+
+class Timer:
+    """Context manager timing its block for Metrics.timer().
+    """
+
+    def __init__(self, metrics, name):
+
+        self.metrics = metrics
+
+        self.name = name
+
+        return
+
+    def __enter__(self):
+
+        self.start_time = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.metrics.observe(self.name, time.perf_counter() - self.start_time)
+
+        return False
+
+# Metrics of this process
+#
+METRICS = Metrics()
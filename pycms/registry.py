@@ -0,0 +1,1734 @@
+"""Registries keeping track of pycms pages and their templates.
+
+   Copyright (c) 2013 Florian Berger <fberger@florian-berger.de>
+"""
+
+# This file is part of pycms.
+#
+# pycms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pycms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pycms.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import bisect
+import hashlib
+import threading
+import functools
+import time
+import sys
+import logging
+from pycms.metrics import METRICS
+
+LOGGER = logging.getLogger("pycms.registry")
+
+def write_file_atomic(path, data, fsync = False):
+    """Write the string or bytes `data` to `path`, replacing the file in a single step.
+
+       Readers will either see the old or the new file, but never a
+       partially written one. If `fsync` is True, the data is flushed to
+       the disk before and after replacing the file, so that it also
+       survives a system crash.
+    """
+
+    # Unique per process and thread, so that concurrent writers do not
+    # share a temporary file
+    #
+    temp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+
+    if isinstance(data, bytes):
+
+        temp_file = open(temp_path, "wb")
+
+    else:
+
+        temp_file = open(temp_path, "wt", encoding = "utf8")
+
+    try:
+        with temp_file:
+
+            temp_file.write(data)
+
+            if fsync:
+
+                temp_file.flush()
+
+                os.fsync(temp_file.fileno())
+
+        os.replace(temp_path, path)
+
+    except BaseException:
+
+        # Do not leave the temporary file behind
+        #
+        try:
+            os.remove(temp_path)
+
+        except OSError:
+
+            pass
+
+        raise
+
+    if fsync:
+
+        fsync_directory(os.path.dirname(path))
+
+    return
+
+def fsync_directory(path):
+    """Flush the directory entries of `path` to disk, where the platform supports it.
+    """
+
+    try:
+        directory_fd = os.open(path or ".", os.O_RDONLY)
+
+    except OSError:
+
+        # Not possible on MS Windows
+        #
+        return
+
+    try:
+        os.fsync(directory_fd)
+
+    finally:
+        os.close(directory_fd)
+
+    return
+
+def synchronised(method):
+    """Decorator running `method` with the instance's `_lock` held.
+    """
+
+    @functools.wraps(method)
+    def synchronised_method(self, *args, **kwargs):
+
+        with self._lock:
+
+            return method(self, *args, **kwargs)
+
+    return synchronised_method
+
+class URIMap:
+    """A map from URIs to template names, persisted as a JSON file.
+
+       The map is read on first access and then kept in memory. On every
+       access, the file is checked with os.stat(), and it is only re-read
+       if its modification time or size changed, e.g. because it was
+       edited by another process.
+
+       Alongside the map, a reverse index from template names to sorted
+       lists of URIs is maintained and persisted, so that the pages
+       using a template can be looked up without scanning the map.
+
+       A sorted list of all URIs is built on the first listing, and a
+       URITrie on the first subtree query or completion. Both are then
+       kept up to date by every change, so that they are not rebuilt
+       from the whole map again.
+
+       All public methods are serialised by a lock, so that a URIMap can
+       be shared by the threads of a server.
+
+       By default, every change rewrites the whole map file. In journal
+       mode, changes are instead appended as single records to a journal
+       file next to the map. Readers replay the journal on top of the
+       last snapshot. Once the journal holds `compact_threshold` records,
+       it is folded into a fresh snapshot. A journal found on disk is
+       always replayed, regardless of the mode.
+
+       Attributes:
+
+       URIMap.path
+           The path to the JSON file holding the map snapshot.
+
+       URIMap.index_path
+           The path to the JSON file holding the reverse index.
+
+       URIMap.journal_path
+           The path to the journal file.
+
+       URIMap.journal
+           Boolean flag whether to journal changes instead of rewriting
+           the map file.
+
+       URIMap.fsync
+           Boolean flag whether to flush all writes to disk.
+
+       URIMap.compact_threshold
+           The number of journal records that triggers a compaction.
+    """
+
+    def __init__(self, path, index_path, journal_path, journal = False, fsync = False, compact_threshold = 10000):
+        """Initialise. The files are not read before the first access.
+        """
+
+        self.path = path
+
+        self.index_path = index_path
+
+        self.journal_path = journal_path
+
+        self.journal = journal
+
+        self.fsync = fsync
+
+        self.compact_threshold = compact_threshold
+
+        # [st_mtime_ns, st_size] of the map file when it was last read
+        # or written, None if it did not exist, False before the first
+        # access.
+        #
+        self._signature = False
+
+        # Same for the journal file, plus the number of bytes and
+        # records replayed from it.
+        #
+        self._journal_signature = None
+
+        self._journal_offset = 0
+
+        self._journal_records = 0
+
+        self._uri_dict = {}
+
+        self._template_dict = {}
+
+        # Sorted list of all URIs, None if not built yet
+        #
+        self._sorted_uris = None
+
+        # URITrie of all URIs, None if not built yet
+        #
+        self._trie = None
+
+        # Reentrant, as saving is done from within other methods
+        #
+        self._lock = threading.RLock()
+
+        return
+
+    def _stat(self, path):
+        """Return the signature of the file at `path`, or None if it does not exist.
+        """
+
+        try:
+            stat_result = os.stat(path)
+
+        except FileNotFoundError:
+
+            return None
+
+        return [stat_result.st_mtime_ns, stat_result.st_size]
+
+    def _refresh(self):
+        """Re-read the map if it changed on disk since it was last read or written.
+        """
+
+        signature = self._stat(self.path)
+
+        journal_signature = self._stat(self.journal_path)
+
+        if signature != self._signature:
+
+            self._load(signature)
+
+            if journal_signature is not None:
+
+                self._replay()
+
+        elif journal_signature != self._journal_signature:
+
+            if journal_signature is not None and journal_signature[1] >= self._journal_offset:
+
+                # The journal has been appended to. Only replay the new
+                # records.
+                #
+                self._replay()
+
+            else:
+
+                # The journal has been compacted or replaced.
+                #
+                self._load(signature)
+
+                if journal_signature is not None:
+
+                    self._replay()
+
+        return
+
+    def _load(self, signature):
+        """Read the map snapshot and its reverse index.
+        """
+
+        with METRICS.timer("map_load"):
+
+            self._read_snapshot(signature)
+
+        return
+
+    def _read_snapshot(self, signature):
+        """Implementation of _load().
+        """
+
+        self._uri_dict = {}
+
+        if signature is not None:
+
+            with open(self.path, "rt", encoding = "utf8") as map_file:
+
+                self._uri_dict = json.loads(map_file.read())
+
+        self._signature = signature
+
+        self._journal_signature = None
+
+        self._journal_offset = 0
+
+        self._journal_records = 0
+
+        self._template_dict = None
+
+        self._sorted_uris = None
+
+        self._trie = None
+
+        # Try the persisted reverse index first. It is only valid if it
+        # was written for exactly this version of the map.
+        #
+        try:
+            with open(self.index_path, "rt", encoding = "utf8") as index_file:
+
+                index_dict = json.loads(index_file.read())
+
+            if index_dict["map"] == signature:
+
+                self._template_dict = index_dict["templates"]
+
+        except (OSError, ValueError, KeyError):
+
+            pass
+
+        if self._template_dict is None:
+
+            self._template_dict = {}
+
+            for uri in sorted(self._uri_dict.keys()):
+
+                self._template_dict.setdefault(self._uri_dict[uri], []).append(uri)
+
+            # Persisting the index only saves the next reader the work,
+            # so a failure, e.g. on a read-only file system, must not
+            # keep the map from being read.
+            #
+            if signature is not None:
+
+                try:
+                    self._save_index()
+
+                except OSError:
+
+                    pass
+
+        return
+
+    def _replay(self):
+        """Apply the journal records not yet seen to the map in memory.
+        """
+
+        with open(self.journal_path, "rb") as journal_file:
+
+            journal_file.seek(self._journal_offset)
+
+            data = journal_file.read()
+
+            self._journal_signature = self._stat(self.journal_path)
+
+        # A record without a trailing newline has been torn by a crash
+        # while it was being written, and is ignored.
+        #
+        end = data.rfind(b"\n") + 1
+
+        for line in data[:end].splitlines():
+
+            record = json.loads(line.decode("utf8"))
+
+            if record[0] == "set":
+
+                self._set(record[1], record[2])
+
+            elif record[0] == "del" and record[1] in self._uri_dict:
+
+                # Records may be replayed on a snapshot which already
+                # contains them, if a compaction was interrupted.
+                #
+                self._delete(record[1])
+
+            self._journal_records += 1
+
+        self._journal_offset += end
+
+        return
+
+    def _append(self, *records):
+        """Append `records` to the journal, and compact it if it has grown too large.
+        """
+
+        if not records:
+
+            return
+
+        data = "".join(json.dumps(record, ensure_ascii = False) + "\n" for record in records).encode("utf8")
+
+        with open(self.journal_path, "ab") as journal_file:
+
+            created = journal_file.tell() == 0
+
+            if journal_file.tell() > self._journal_offset:
+
+                # Cut off a torn record left behind by a crash
+                #
+                journal_file.truncate(self._journal_offset)
+
+            journal_file.write(data)
+
+            if self.fsync:
+
+                journal_file.flush()
+
+                os.fsync(journal_file.fileno())
+
+        if created and self.fsync:
+
+            fsync_directory(os.path.dirname(self.journal_path))
+
+        self._journal_offset += len(data)
+
+        self._journal_records += len(records)
+
+        self._journal_signature = self._stat(self.journal_path)
+
+        if self._journal_records >= self.compact_threshold:
+
+            self.save()
+
+        return
+
+    def _save_index(self):
+        """Persist the reverse index, tagged with the signature of the current map file.
+        """
+
+        write_file_atomic(self.index_path,
+                          json.dumps({"map": self._signature,
+                                      "templates": self._template_dict},
+                                     sort_keys = True,
+                                     ensure_ascii = False),
+                          fsync = self.fsync)
+
+        return
+
+    @synchronised
+    def save(self):
+        """Write a snapshot of the map and its reverse index to disk, and discard the journal.
+        """
+
+        write_file_atomic(self.path,
+                          json.dumps(self._uri_dict,
+                                     sort_keys = True,
+                                     ensure_ascii = False),
+                          fsync = self.fsync)
+
+        self._signature = self._stat(self.path)
+
+        self._save_index()
+
+        # Should we crash before this, the journal will be replayed on
+        # top of the new snapshot, which does no harm.
+        #
+        if os.path.exists(self.journal_path):
+
+            os.remove(self.journal_path)
+
+        self._journal_signature = None
+
+        self._journal_offset = 0
+
+        self._journal_records = 0
+
+        return
+
+    @synchronised
+    def compact(self):
+        """Fold the journal into a fresh snapshot of the map.
+        """
+
+        self._refresh()
+
+        self.save()
+
+        return
+
+    @synchronised
+    def __getitem__(self, uri):
+
+        self._refresh()
+
+        return self._uri_dict[uri]
+
+    @synchronised
+    def __contains__(self, uri):
+
+        self._refresh()
+
+        return uri in self._uri_dict
+
+    @synchronised
+    def __len__(self):
+
+        self._refresh()
+
+        return len(self._uri_dict)
+
+    @synchronised
+    def get(self, uri, default = None):
+        """Return the template of `uri`, or `default` if `uri` is not registered.
+        """
+
+        self._refresh()
+
+        return self._uri_dict.get(uri, default)
+
+    @synchronised
+    def __setitem__(self, uri, template):
+        """Register `uri` with `template` and save the map.
+        """
+
+        self._refresh()
+
+        self._set(uri, template)
+
+        if self.journal:
+
+            self._append(["set", uri, template])
+
+        else:
+
+            self.save()
+
+        return
+
+    @synchronised
+    def __delitem__(self, uri):
+        """Unregister `uri` and save the map.
+        """
+
+        self._refresh()
+
+        self._delete(uri)
+
+        if self.journal:
+
+            self._append(["del", uri])
+
+        else:
+
+            self.save()
+
+        return
+
+    @synchronised
+    def set_many(self, items):
+        """Register all (uri, template) tuples in `items`, and save the map once.
+        """
+
+        self._refresh()
+
+        records = []
+
+        for uri, template in items:
+
+            self._set(uri, template)
+
+            records.append(["set", uri, template])
+
+        if not records:
+
+            return
+
+        if self.journal and len(records) < self.compact_threshold:
+
+            self._append(*records)
+
+        else:
+
+            self.save()
+
+        return
+
+    @synchronised
+    def delete_many(self, uris):
+        """Unregister all URIs in `uris`, and save the map once.
+        """
+
+        self._refresh()
+
+        records = []
+
+        for uri in uris:
+
+            self._delete(uri)
+
+            records.append(["del", uri])
+
+        if not records:
+
+            return
+
+        if self.journal and len(records) < self.compact_threshold:
+
+            self._append(*records)
+
+        else:
+
+            self.save()
+
+        return
+
+    def _set(self, uri, template):
+        """Register `uri` with `template` in memory.
+        """
+
+        if uri in self._uri_dict:
+
+            self._delete(uri)
+
+        self._uri_dict[uri] = template
+
+        if self._sorted_uris is not None:
+
+            bisect.insort(self._sorted_uris, uri)
+
+        if self._trie is not None:
+
+            self._trie.add(uri)
+
+        bisect.insort(self._template_dict.setdefault(template, []), uri)
+
+        return
+
+    def _delete(self, uri):
+        """Unregister `uri` in memory.
+        """
+
+        template = self._uri_dict.pop(uri)
+
+        uris = self._template_dict[template]
+
+        del uris[bisect.bisect_left(uris, uri)]
+
+        if not uris:
+
+            del self._template_dict[template]
+
+        if self._sorted_uris is not None:
+
+            del self._sorted_uris[bisect.bisect_left(self._sorted_uris, uri)]
+
+        if self._trie is not None:
+
+            self._trie.discard(uri)
+
+        return
+
+    def _trie_view(self):
+        """Return the cached URITrie of all URIs. The trie must not be modified.
+        """
+
+        self._refresh()
+
+        if self._trie is None:
+
+            self._trie = URITrie(self._uri_dict.keys())
+
+        return self._trie
+
+    def _sorted_view(self):
+        """Return the cached sorted list of all URIs. The list must not be modified.
+        """
+
+        self._refresh()
+
+        if self._sorted_uris is None:
+
+            self._sorted_uris = sorted(self._uri_dict.keys())
+
+        return self._sorted_uris
+
+    @synchronised
+    def items(self):
+        """Return a list of (uri, template) tuples, sorted by URI.
+        """
+
+        uris = self._sorted_view()
+
+        return [(uri, self._uri_dict[uri]) for uri in uris]
+
+    @synchronised
+    def uris(self):
+        """Return a sorted list of all registered URIs.
+        """
+
+        return list(self._sorted_view())
+
+    @synchronised
+    def templates(self):
+        """Return a sorted list of the templates in use.
+        """
+
+        self._refresh()
+
+        return sorted(self._template_dict.keys())
+
+    @synchronised
+    def uris_for_template(self, template):
+        """Return a sorted list of the URIs using `template`.
+        """
+
+        self._refresh()
+
+        return list(self._template_dict.get(template, []))
+
+    @synchronised
+    def count_for_template(self, template):
+        """Return the number of URIs using `template`.
+        """
+
+        self._refresh()
+
+        return len(self._template_dict.get(template, []))
+
+    @synchronised
+    def uris_with_prefix(self, prefix):
+        """Return a sorted list of the URIs starting with `prefix`.
+        """
+
+        uris = self._sorted_view()
+
+        start, end = prefix_range(uris, prefix)
+
+        return uris[start:end]
+
+    @synchronised
+    def list_items(self, prefix = "", template = None, offset = 0, limit = None):
+        """Return a tuple (total, items) for one page of a listing.
+
+           The listing holds the URIs starting with `prefix` and, if
+           `template` is given, using that template, sorted by URI.
+           `total` is the length of the whole listing, and `items` the
+           list of (uri, template) tuples of at most `limit` entries,
+           starting at `offset`.
+        """
+
+        if template is None:
+
+            uris = self._sorted_view()
+
+        else:
+
+            self._refresh()
+
+            uris = self._template_dict.get(template, [])
+
+        start, end = prefix_range(uris, prefix)
+
+        page_end = end
+
+        if limit is not None:
+
+            page_end = min(end, start + offset + limit)
+
+        return (end - start,
+                [(uri, self._uri_dict[uri]) for uri in uris[start + offset:page_end]])
+
+    @synchronised
+    def subtree(self, uri):
+        """Return a sorted list of `uri` and all registered URIs below it.
+        """
+
+        return self._trie_view().subtree(uri)
+
+    @synchronised
+    def complete(self, text):
+        """Return a sorted list of the URIs one level below the last slash in `text` which start with `text`.
+        """
+
+        return self._trie_view().complete(text)
+
+    @synchronised
+    def remove_files(self):
+        """Delete the files holding the map from disk.
+        """
+
+        for path in (self.path, self.index_path, self.journal_path):
+
+            if os.path.exists(path):
+
+                os.remove(path)
+
+        self._signature = False
+
+        return
+
+class URITrie:
+    """A prefix tree of URIs, with one node per URI path component.
+
+       Nodes for URIs which only lead to deeper URIs, but are not
+       registered themselves, are kept as well, so that completion can
+       descend through them.
+    """
+
+    def __init__(self, uris = ()):
+        """Initialise, adding all URIs in `uris`.
+        """
+
+        self._root = URITrieNode()
+
+        for uri in uris:
+
+            self.add(uri)
+
+        return
+
+    def _find(self, uri):
+        """Return the node for `uri`, or None if there is none.
+        """
+
+        node = self._root
+
+        for component in split_uri(uri):
+
+            node = node.children.get(component)
+
+            if node is None:
+
+                return None
+
+        return node
+
+    def __contains__(self, uri):
+
+        node = self._find(uri)
+
+        return node is not None and node.page
+
+    def add(self, uri):
+        """Add `uri` to the trie.
+        """
+
+        node = self._root
+
+        for component in split_uri(uri):
+
+            child = node.children.get(component)
+
+            if child is None:
+
+                child = node.children[component] = URITrieNode()
+
+            node = child
+
+        node.page = True
+
+        return
+
+    def discard(self, uri):
+        """Remove `uri` from the trie, if present, and drop the nodes which no longer lead anywhere.
+        """
+
+        path = [self._root]
+
+        components = split_uri(uri)
+
+        for component in components:
+
+            node = path[-1].children.get(component)
+
+            if node is None:
+
+                return
+
+            path.append(node)
+
+        path[-1].page = False
+
+        while len(path) > 1 and not path[-1].page and not path[-1].children:
+
+            path.pop()
+
+            del path[-1].children[components[len(path) - 1]]
+
+        return
+
+    def subtree(self, uri):
+        """Return a sorted list of `uri`, if present, and all URIs below it.
+        """
+
+        node = self._find(uri)
+
+        uris = []
+
+        if node is None:
+
+            return uris
+
+        # Depth first, visiting children in sorted order. Stack entries
+        # are (uri, node) tuples.
+        #
+        stack = [("/" + "/".join(split_uri(uri)), node)]
+
+        while stack:
+
+            node_uri, node = stack.pop()
+
+            if node.page:
+
+                uris.append(node_uri)
+
+            for component in sorted(node.children.keys(), reverse = True):
+
+                stack.append(("{}/{}".format(node_uri.rstrip("/"), component), node.children[component]))
+
+        # "/a/b" sorts before "/a-b", but is visited after it
+        #
+        uris.sort()
+
+        return uris
+
+    def complete(self, text):
+        """Return a sorted list of the URIs one level below the last slash in `text` which start with `text`.
+        """
+
+        parent, slash, partial = text.rpartition("/")
+
+        node = self._find(parent)
+
+        if node is None:
+
+            return []
+
+        return ["{}/{}".format(parent, component)
+                for component in sorted(node.children.keys())
+                if component.startswith(partial)]
+
+class URITrieNode:
+    """A node of a URITrie.
+    """
+
+    __slots__ = ("children", "page")
+
+    def __init__(self):
+
+        # Map of path components to child nodes
+        #
+        self.children = {}
+
+        # Whether the URI ending at this node is registered
+        #
+        self.page = False
+
+        return
+
+class TemplateRegistry:
+    """The templates of a pycms instance, with cached content hashes and placeholder structure.
+
+       Templates are the '*.html' files of the templates folder. Other
+       files, e.g. left there by editors, are ignored. Template files
+       are listed on every query, but only read again if their
+       modification time or size changed. The backup made by
+       Instance.edit_template() is tracked along with each template, so
+       that templates whose content actually changed can be told from
+       those whose backup is identical to the current file.
+
+       Attributes:
+
+       TemplateRegistry.path
+           The path to the templates folder.
+
+       TemplateRegistry.uri_map
+           The URI map used to count the pages using each template.
+    """
+
+    # Suffix of template files, and of template backups
+    #
+    TEMPLATE_SUFFIX = ".html"
+
+    BACKUP_SUFFIX = ".old"
+
+    def __init__(self, path, uri_map):
+        """Initialise. The templates folder is not read before the first access.
+        """
+
+        self.path = path
+
+        self.uri_map = uri_map
+
+        # Template name -> dict with the keys "signature", "hash",
+        # "source" and "tokenised" of the template, "compiled" once the
+        # template has been compiled, and "backup", holding the
+        # "signature" and "hash" of the backup, or None.
+        #
+        self._templates = {}
+
+        self._lock = threading.Lock()
+
+        return
+
+    def _read(self, path, signature):
+        """Return a dict with the signature and the hash of the file at `path`, plus its content.
+        """
+
+        with open(path, "rb") as template_file:
+
+            data = template_file.read()
+
+        return {"signature": signature,
+                "hash": hashlib.sha1(data).hexdigest(),
+                "data": data}
+
+    def refresh(self):
+        """Bring the cached information up to date with the templates folder.
+        """
+
+        import pycms
+
+        signatures = {}
+
+        try:
+            entries = list(os.scandir(self.path))
+
+        except FileNotFoundError:
+
+            entries = []
+
+        for entry in entries:
+
+            if entry.is_file() and not entry.name.startswith("."):
+
+                stat_result = entry.stat()
+
+                signatures[entry.name] = [stat_result.st_mtime_ns, stat_result.st_size]
+
+        with self._lock:
+
+            templates = {}
+
+            for name in signatures.keys():
+
+                if not name.endswith(self.TEMPLATE_SUFFIX):
+
+                    continue
+
+                template = self._templates.get(name)
+
+                backup_signature = signatures.get(name + self.BACKUP_SUFFIX)
+
+                try:
+                    if template is None or template["signature"] != signatures[name]:
+
+                        template = self._read(os.path.join(self.path, name), signatures[name])
+
+                        template["source"] = template.pop("data").decode("utf8")
+
+                        template["tokenised"] = pycms.LineReplacement.tokenise(template["source"])
+
+                        template["backup"] = None
+
+                    if backup_signature is None:
+
+                        template["backup"] = None
+
+                    elif template["backup"] is None or template["backup"]["signature"] != backup_signature:
+
+                        template["backup"] = self._read(os.path.join(self.path, name + self.BACKUP_SUFFIX), backup_signature)
+
+                        del template["backup"]["data"]
+
+                except FileNotFoundError:
+
+                    # Removed since the folder was listed
+                    #
+                    continue
+
+                templates[name] = template
+
+            self._templates = templates
+
+        return
+
+    def names(self):
+        """Return a sorted list of the template names.
+        """
+
+        self.refresh()
+
+        return sorted(self._templates.keys())
+
+    def __contains__(self, name):
+
+        self.refresh()
+
+        return name in self._templates
+
+    def hash(self, name):
+        """Return the SHA-1 hex digest of the content of template `name`.
+        """
+
+        self.refresh()
+
+        return self._templates[name]["hash"]
+
+    def tokenised(self, name):
+        """Return template `name` split at its placeholders, as returned by LineReplacement.tokenise().
+        """
+
+        self.refresh()
+
+        return self._templates[name]["tokenised"]
+
+    def compiled(self, name):
+        """Return a tuple (hash, mtime_ns, compiled) for template `name`, `compiled` being its source as returned by LineReplacement.compile().
+
+           The template is compiled once, and again only after the
+           template file changed. To tell, only the file of template
+           `name` is examined.
+        """
+
+        import pycms
+
+        template = self._templates.get(name)
+
+        # Checking the one template is enough if it is known already
+        #
+        try:
+            stat_result = os.stat(os.path.join(self.path, name))
+
+            signature = [stat_result.st_mtime_ns, stat_result.st_size]
+
+        except FileNotFoundError:
+
+            signature = None
+
+        if template is None or template["signature"] != signature:
+
+            self.refresh()
+
+            template = self._templates[name]
+
+        compiled = template.get("compiled")
+
+        if compiled is None:
+
+            compiled = template["compiled"] = pycms.LineReplacement.compile(template["source"], template["tokenised"][1])
+
+        return (template["hash"], template["signature"][0], compiled)
+
+    def placeholders(self, name):
+        """Return a tuple of the placeholder names in template `name`, in order.
+        """
+
+        return self.tokenised(name)[1]
+
+    def usage(self):
+        """Return a dict mapping each template name to the number of pages using it.
+        """
+
+        return dict((name, self.uri_map.count_for_template(name)) for name in self.names())
+
+    def backups(self):
+        """Return a sorted list of the names of templates which have a backup.
+        """
+
+        self.refresh()
+
+        return sorted(name for name in self._templates.keys() if self._templates[name]["backup"] is not None)
+
+    def changed(self):
+        """Return a sorted list of the names of templates whose content differs from their backup.
+        """
+
+        self.refresh()
+
+        return [name for name in self.backups()
+                if self._templates[name]["backup"]["hash"] != self._templates[name]["hash"]]
+
+    def unchanged(self):
+        """Return a sorted list of the names of templates with a backup identical to the current file.
+        """
+
+        self.refresh()
+
+        return [name for name in self.backups()
+                if self._templates[name]["backup"]["hash"] == self._templates[name]["hash"]]
+
+class RoutingTable:
+    """An in-memory table of the pages of a pycms instance, mapping each URI to its template and page content.
+
+       A server can answer requests for pages from the table without
+       touching disk. Template names are interned, so that all pages
+       using a template share one string, and each page is held as a
+       single bytes object.
+
+       reload() brings the table up to date with the URI map, and only
+       reads the page files whose modification time or size changed.
+
+       Attributes:
+
+       RoutingTable.htmlroot
+           The path to the instance's root directory.
+
+       RoutingTable.uri_map
+           The URI map listing the pages.
+
+       RoutingTable.reload_interval
+           Seconds after which render() has the table reloaded in a
+           background thread, or None to only reload explicitly.
+    """
+
+    def __init__(self, htmlroot, uri_map, reload_interval = None):
+        """Initialise with an empty table.
+        """
+
+        self.htmlroot = htmlroot
+
+        self.uri_map = uri_map
+
+        self.reload_interval = reload_interval
+
+        # URI -> (template, st_mtime_ns, body). The dict is replaced as
+        # a whole on reload, so readers never see a partial table.
+        #
+        self._routes = {}
+
+        self._reloaded = None
+
+        self._lock = threading.Lock()
+
+        return
+
+    def reload(self):
+        """Bring the table up to date with the URI map and the page files.
+
+           Returns the number of page files read.
+        """
+
+        with self._lock:
+
+            return self._reload()
+
+    def _reload(self):
+        """Implementation of reload(), to be called with the lock held.
+        """
+
+        import pycms
+
+        routes = {}
+
+        previous_routes = self._routes
+
+        read = 0
+
+        bytes_read = 0
+
+        for uri, template in self.uri_map.items():
+
+            path = os.path.join(*[self.htmlroot] + uri.split("/") + [pycms.PAGE_FILE])
+
+            try:
+                stat_result = os.stat(path)
+
+                route = previous_routes.get(uri)
+
+                if route is None or route[1] != stat_result.st_mtime_ns or len(route[2]) != stat_result.st_size:
+
+                    with open(path, "rb") as page_file:
+
+                        body = page_file.read()
+
+                    read += 1
+
+                    bytes_read += len(body)
+
+                    route = (sys.intern(template), stat_result.st_mtime_ns, body)
+
+                elif route[0] != template:
+
+                    route = (sys.intern(template),) + route[1:]
+
+            except FileNotFoundError:
+
+                # Removed since the map was read
+                #
+                continue
+
+            routes[uri] = route
+
+        self._routes = routes
+
+        self._reloaded = time.monotonic()
+
+        METRICS.count("bytes_read", bytes_read)
+
+        return read
+
+    def _reload_in_background(self):
+        """Reload the table, and release the lock acquired by render().
+        """
+
+        try:
+            self._reload()
+
+        except Exception:
+
+            # Retried after the next interval
+            #
+            self._reloaded = time.monotonic()
+
+            LOGGER.exception("Reloading the routing table failed")
+
+        finally:
+
+            self._lock.release()
+
+        return
+
+    def get(self, uri):
+        """Return a tuple (template, body) for the page under `uri`, or None if there is none.
+        """
+
+        route = self._routes.get(uri)
+
+        if route is None:
+
+            return None
+
+        return (route[0], route[2])
+
+    def __contains__(self, uri):
+
+        return uri in self._routes
+
+    def __len__(self):
+
+        return len(self._routes)
+
+    def uris(self):
+        """Return a sorted list of the URIs in the table.
+        """
+
+        return sorted(self._routes.keys())
+
+    def render(self, uri, encoding = None):
+        """Return a tuple (body, etag, mtime, encoding) for the page under `uri`, or None if there is none. See pycms.CMS.render().
+
+           Bodies are never compressed. If `reload_interval` has passed
+           since the last reload, a reload is started in a background
+           thread, unless one is running already. The request is
+           answered from the table as it is.
+        """
+
+        if (self.reload_interval is not None
+            and (self._reloaded is None or time.monotonic() - self._reloaded >= self.reload_interval)
+            and self._lock.acquire(blocking = False)):
+
+            try:
+                threading.Thread(target = self._reload_in_background,
+                                 name = "pycms_routes_reload",
+                                 daemon = True).start()
+
+            except BaseException:
+
+                self._lock.release()
+
+                raise
+
+        route = self._routes.get(uri)
+
+        if route is None:
+
+            return None
+
+        # The page's signature identifies its content
+        #
+        return (route[2],
+                "{:x}-{:x}".format(route[1], len(route[2])),
+                route[1] / 1e9,
+                None)
+
+def split_uri(uri):
+    """Return a list of the path components of `uri`.
+    """
+
+    return [component for component in uri.split("/") if component]
+
+def prefix_range(uris, prefix):
+    """Return a tuple (start, end) of the slice of the sorted list `uris` holding the URIs starting with `prefix`.
+    """
+
+    start = bisect.bisect_left(uris, prefix)
+
+    if not prefix:
+
+        return (start, len(uris))
+
+    # All strings starting with `prefix` sort below this one
+    #
+    end = bisect.bisect_left(uris, prefix_upper_bound(prefix), lo = start)
+
+    return (start, end)
+
+def prefix_upper_bound(prefix):
+    """Return the smallest string that sorts after all strings starting with `prefix`.
+    """
+
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class SQLiteURIMap:
+    """A map from URIs to template names, stored in an SQLite database.
+
+       SQLiteURIMap offers the same interface as URIMap, but does not
+       hold the map in memory. URIs and templates are indexed, so that
+       lookups by URI, URI prefix or template are index lookups rather
+       than scans.
+
+       The database is opened on first access. A single connection is
+       shared by all threads, guarded by a lock. Connections must not
+       be used across fork(), so close() has to be called before
+       forking.
+
+       Attributes:
+
+       SQLiteURIMap.path
+           The path to the database file.
+
+       SQLiteURIMap.fsync
+           Boolean flag whether every transaction should be flushed to
+           disk before it is reported complete.
+    """
+
+    def __init__(self, path, fsync = False):
+        """Initialise. The database is not opened before the first access.
+        """
+
+        self.path = path
+
+        self.fsync = fsync
+
+        self._connection = None
+
+        self._lock = threading.RLock()
+
+        return
+
+    def _execute(self, statement, parameters = ()):
+        """Execute `statement`, and return a list of all result rows.
+        """
+
+        with self._lock:
+
+            if self._connection is None:
+
+                import sqlite3
+
+                self._connection = sqlite3.connect(self.path, check_same_thread = False)
+
+                self._connection.execute("PRAGMA journal_mode = WAL")
+
+                self._connection.execute("PRAGMA synchronous = {}".format("FULL" if self.fsync else "NORMAL"))
+
+                with self._connection:
+
+                    self._connection.execute("CREATE TABLE IF NOT EXISTS pages (uri TEXT PRIMARY KEY, template TEXT NOT NULL) WITHOUT ROWID")
+
+                    self._connection.execute("CREATE INDEX IF NOT EXISTS pages_by_template ON pages (template, uri)")
+
+            with self._connection:
+
+                return self._connection.execute(statement, parameters).fetchall()
+
+    def __getitem__(self, uri):
+
+        rows = self._execute("SELECT template FROM pages WHERE uri = ?", (uri,))
+
+        if not rows:
+
+            raise KeyError(uri)
+
+        return rows[0][0]
+
+    def __contains__(self, uri):
+
+        return bool(self._execute("SELECT 1 FROM pages WHERE uri = ?", (uri,)))
+
+    def __len__(self):
+
+        return self._execute("SELECT COUNT(*) FROM pages")[0][0]
+
+    def get(self, uri, default = None):
+        """Return the template of `uri`, or `default` if `uri` is not registered.
+        """
+
+        rows = self._execute("SELECT template FROM pages WHERE uri = ?", (uri,))
+
+        if not rows:
+
+            return default
+
+        return rows[0][0]
+
+    def __setitem__(self, uri, template):
+        """Register `uri` with `template`.
+        """
+
+        self._execute("INSERT OR REPLACE INTO pages (uri, template) VALUES (?, ?)", (uri, template))
+
+        return
+
+    def __delitem__(self, uri):
+        """Unregister `uri`.
+        """
+
+        with self._lock:
+
+            if uri not in self:
+
+                raise KeyError(uri)
+
+            self._execute("DELETE FROM pages WHERE uri = ?", (uri,))
+
+        return
+
+    def set_many(self, items):
+        """Register all (uri, template) tuples in `items` in a single transaction.
+        """
+
+        # Make sure the database is open
+        #
+        len(self)
+
+        with self._lock, self._connection:
+
+            self._connection.executemany("INSERT OR REPLACE INTO pages (uri, template) VALUES (?, ?)", items)
+
+        return
+
+    def items(self):
+        """Return a list of (uri, template) tuples, sorted by URI.
+        """
+
+        return self._execute("SELECT uri, template FROM pages ORDER BY uri")
+
+    def uris(self):
+        """Return a sorted list of all registered URIs.
+        """
+
+        return [row[0] for row in self._execute("SELECT uri FROM pages ORDER BY uri")]
+
+    def templates(self):
+        """Return a sorted list of the templates in use.
+        """
+
+        return [row[0] for row in self._execute("SELECT DISTINCT template FROM pages ORDER BY template")]
+
+    def uris_for_template(self, template):
+        """Return a sorted list of the URIs using `template`.
+        """
+
+        return [row[0] for row in self._execute("SELECT uri FROM pages WHERE template = ? ORDER BY uri", (template,))]
+
+    def count_for_template(self, template):
+        """Return the number of URIs using `template`.
+        """
+
+        return self._execute("SELECT COUNT(*) FROM pages WHERE template = ?", (template,))[0][0]
+
+    def uris_with_prefix(self, prefix):
+        """Return a sorted list of the URIs starting with `prefix`.
+        """
+
+        if not prefix:
+
+            return self.uris()
+
+        # Express the prefix as a range, so that the primary key index
+        # is used. With the default binary collation, SQLite sorts
+        # strings like Python does.
+        #
+        return [row[0] for row in self._execute("SELECT uri FROM pages WHERE uri >= ? AND uri < ? ORDER BY uri",
+                                                (prefix, prefix_upper_bound(prefix)))]
+
+    def list_items(self, prefix = "", template = None, offset = 0, limit = None):
+        """Return a tuple (total, items) for one page of a listing. See URIMap.list_items().
+        """
+
+        conditions = []
+
+        parameters = []
+
+        if prefix:
+
+            conditions.append("uri >= ? AND uri < ?")
+
+            parameters.extend((prefix, prefix_upper_bound(prefix)))
+
+        if template is not None:
+
+            conditions.append("template = ?")
+
+            parameters.append(template)
+
+        where = ""
+
+        if conditions:
+
+            where = " WHERE " + " AND ".join(conditions)
+
+        with self._lock:
+
+            total = self._execute("SELECT COUNT(*) FROM pages" + where, parameters)[0][0]
+
+            items = self._execute("SELECT uri, template FROM pages" + where + " ORDER BY uri LIMIT ? OFFSET ?",
+                                  parameters + [-1 if limit is None else limit, offset])
+
+        return (total, items)
+
+    def delete_many(self, uris):
+        """Unregister all URIs in `uris` in a single transaction.
+        """
+
+        # Make sure the database is open
+        #
+        len(self)
+
+        with self._lock, self._connection:
+
+            for uri in uris:
+
+                if not self._connection.execute("DELETE FROM pages WHERE uri = ?", (uri,)).rowcount:
+
+                    raise KeyError(uri)
+
+        return
+
+    def subtree(self, uri):
+        """Return a sorted list of `uri`, if registered, and all registered URIs below it.
+        """
+
+        uri = "/" + "/".join(split_uri(uri))
+
+        uris = self.uris_with_prefix(uri.rstrip("/") + "/")
+
+        if uri == "/" or uri not in self:
+
+            return uris
+
+        return [uri] + uris
+
+    def complete(self, text):
+        """Return a sorted list of the URIs one level below the last slash in `text` which start with `text`.
+        """
+
+        parent = text.rpartition("/")[0]
+
+        upper_bound = prefix_upper_bound(text or "/")
+
+        completions = set()
+
+        # Skip from child to child, using one index lookup each, instead
+        # of reading all URIs below `parent`.
+        #
+        lower_bound = text
+
+        operator = ">="
+
+        while True:
+
+            rows = self._execute("SELECT uri FROM pages WHERE uri {} ? AND uri < ? ORDER BY uri LIMIT 1".format(operator),
+                                 (lower_bound, upper_bound))
+
+            if not rows:
+
+                return sorted(completions)
+
+            component, slash, rest = rows[0][0][len(parent) + 1:].partition("/")
+
+            if component:
+
+                completions.add("{}/{}".format(parent, component))
+
+            if slash:
+
+                # Skip the URIs below this child. Siblings like
+                # "child-2" sort between "child" and "child/...", so
+                # a child may be found more than once.
+                #
+                lower_bound = prefix_upper_bound("{}/{}/".format(parent, component))
+
+                operator = ">="
+
+            else:
+
+                lower_bound = rows[0][0]
+
+                operator = ">"
+
+    def save(self):
+        """Present for compatibility with URIMap. All changes are committed immediately.
+        """
+
+        return
+
+    def compact(self):
+        """Fold the write-ahead log into the database file.
+        """
+
+        self._execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        return
+
+    def close(self):
+        """Close the database connection.
+        """
+
+        with self._lock:
+
+            if self._connection is not None:
+
+                self._connection.close()
+
+                self._connection = None
+
+        return
+
+    def remove_files(self):
+        """Close the database and delete its files from disk.
+        """
+
+        self.close()
+
+        for path in (self.path, self.path + "-wal", self.path + "-shm"):
+
+            if os.path.exists(path):
+
+                os.remove(path)
+
+        return
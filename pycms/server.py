@@ -0,0 +1,1184 @@
+"""HTTP server for pycms instances.
+
+   Copyright (c) 2013 Florian Berger <fberger@florian-berger.de>
+"""
+
+# This file is part of pycms.
+#
+# pycms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pycms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pycms.  If not, see <http://www.gnu.org/licenses/>.
+
+import http.server
+import socketserver
+import concurrent.futures
+import urllib.parse
+import collections
+import threading
+import os
+import hashlib
+import email.utils
+import socket
+import signal
+import time
+import sys
+import logging
+import pycms
+from pycms.metrics import METRICS
+
+LOGGER = logging.getLogger("pycms.server")
+
+# Requests are logged at INFO level to this logger
+#
+ACCESS_LOGGER = logging.getLogger("pycms.access")
+
+# Seconds an idle keep-alive connection may hold a worker thread
+#
+KEEP_ALIVE_TIMEOUT = 5
+
+# Files up to this size are read into memory to be served, if there is
+# no page cache
+#
+INLINE_LIMIT = 1024 * 1024
+
+# Forked workers are restarted at most this many times within
+# WORKER_RESTART_WINDOW seconds, before serving is given up
+#
+WORKER_RESTART_LIMIT = 10
+
+WORKER_RESTART_WINDOW = 60.0
+
+# Exit status of a forked worker that could not create its server
+#
+WORKER_STARTUP_FAILED = 3
+
+# Default Cache-Control headers by path prefix
+#
+CACHE_CONTROL = {"/": "no-cache",
+                 "/static/": "public, max-age=86400"}
+
+def page_hash(path, stat_result, body):
+    """Return the SHA-1 hex digest of `body`, read from `path`.
+
+       For pycms pages, the digest stored at write time is used if the
+       file has not been changed since.
+    """
+
+    if os.path.basename(path) == pycms.PAGE_FILE:
+
+        page_meta_dict = pycms.read_page_meta(os.path.dirname(path))
+
+        if page_meta_dict is not None and page_meta_dict["signature"] == [stat_result.st_mtime_ns, stat_result.st_size]:
+
+            return page_meta_dict["hash"]
+
+    return hashlib.sha1(body).hexdigest()
+
+class PageCache:
+    """A cache for response bodies and headers, bounded by a byte budget, evicting the least recently used entries.
+
+       Entries are stored along with a signature of the file they were
+       read from. A lookup with a different signature, e.g. because the
+       file has been modified on disk, is a miss.
+
+       Attributes:
+
+       PageCache.max_bytes
+           The maximum number of body bytes to hold.
+
+       PageCache.hits, PageCache.misses, PageCache.evictions
+           Counters for cache lookups and evicted entries.
+    """
+
+    def __init__(self, max_bytes):
+        """Initialise with a budget of `max_bytes`.
+        """
+
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+
+        self.misses = 0
+
+        self.evictions = 0
+
+        self._bytes = 0
+
+        # Maps keys to (signature, body, headers) tuples, least
+        # recently used first
+        #
+        self._entries = collections.OrderedDict()
+
+        self._lock = threading.Lock()
+
+        return
+
+    def get(self, key, signature):
+        """Return a tuple (body, headers) for `key` if it is cached with `signature`, or None.
+        """
+
+        with self._lock:
+
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] != signature:
+
+                self.misses += 1
+
+                return None
+
+            self._entries.move_to_end(key)
+
+            self.hits += 1
+
+            return entry[1:]
+
+    def put(self, key, signature, body, headers):
+        """Store `body` and `headers` for `key`, evicting old entries as necessary.
+
+           Bodies larger than a quarter of the budget are not cached.
+        """
+
+        if len(body) > self.max_bytes // 4:
+
+            return
+
+        with self._lock:
+
+            self._remove(key)
+
+            self._entries[key] = (signature, body, headers)
+
+            self._bytes += len(body)
+
+            while self._bytes > self.max_bytes:
+
+                self._remove(next(iter(self._entries)))
+
+                self.evictions += 1
+
+        return
+
+    def invalidate(self, key):
+        """Drop the entry for `key`, if any.
+        """
+
+        with self._lock:
+
+            self._remove(key)
+
+        return
+
+    def clear(self):
+        """Drop all entries.
+        """
+
+        with self._lock:
+
+            self._entries.clear()
+
+            self._bytes = 0
+
+        return
+
+    def _remove(self, key):
+
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+
+            self._bytes -= len(entry[1])
+
+        return
+
+    def stats(self):
+        """Return a dict of cache counters and sizes.
+        """
+
+        with self._lock:
+
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self._entries),
+                    "bytes": self._bytes,
+                    "max_bytes": self.max_bytes}
+
+class ThreadPoolHTTPServer(socketserver.TCPServer):
+    """A TCP server handling each connection in a bounded pool of worker threads.
+
+       Attributes:
+
+       ThreadPoolHTTPServer.document_root
+           The directory to serve files from.
+
+       ThreadPoolHTTPServer.executor
+           The concurrent.futures.ThreadPoolExecutor handling connections.
+
+       ThreadPoolHTTPServer.page_cache
+           A PageCache for served files, or None.
+
+       ThreadPoolHTTPServer.cache_control
+           A dict mapping URI path prefixes to Cache-Control header
+           values. The longest matching prefix applies.
+
+       ThreadPoolHTTPServer.metrics_path
+           The URI path under which the metrics of this process are
+           served, or None to not serve them.
+
+       ThreadPoolHTTPServer.renderer
+           A pycms.CMS rendering pages on request, a pycms.RoutingTable
+           holding them in memory, or None to serve the page files.
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, RequestHandlerClass, document_root, threads = 10, page_cache = None, cache_control = None, listening_socket = None, reuse_port = False, metrics_path = None, renderer = None):
+        """Initialise, and bind to `server_address`. `threads` is the number of worker threads.
+
+           If `listening_socket` is given, it is used instead of binding a
+           new socket. If `reuse_port` is True, the socket is bound with
+           SO_REUSEPORT, so that several processes can listen on the same
+           port.
+        """
+
+        self.reuse_port = reuse_port
+
+        self.document_root = document_root
+
+        self.page_cache = page_cache
+
+        if cache_control is None:
+
+            cache_control = CACHE_CONTROL
+
+        self.cache_control = cache_control
+
+        self.metrics_path = metrics_path
+
+        self.renderer = renderer
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = threads,
+                                                              thread_name_prefix = "pycms_worker")
+
+        socketserver.TCPServer.__init__(self,
+                                        server_address,
+                                        RequestHandlerClass,
+                                        bind_and_activate = listening_socket is None)
+
+        if listening_socket is not None:
+
+            self.socket.close()
+
+            self.socket = listening_socket
+
+            self.server_address = listening_socket.getsockname()
+
+        return
+
+    def server_bind(self):
+        """socketserver.TCPServer standard method: bind the socket, with SO_REUSEPORT if requested.
+        """
+
+        if self.reuse_port:
+
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        socketserver.TCPServer.server_bind(self)
+
+        return
+
+    def process_request(self, request, client_address):
+        """socketserver.TCPServer standard method: hand the connection to a worker thread.
+        """
+
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+        return
+
+    def process_request_thread(self, request, client_address):
+        """Handle a connection in a worker thread.
+        """
+
+        try:
+            self.finish_request(request, client_address)
+
+        except Exception:
+
+            self.handle_error(request, client_address)
+
+        finally:
+
+            self.shutdown_request(request)
+
+        return
+
+    def server_close(self):
+        """socketserver.TCPServer standard method: close the socket and wait for running requests to finish.
+        """
+
+        socketserver.TCPServer.server_close(self)
+
+        self.executor.shutdown(wait = True)
+
+        return
+
+def serve_forked(create_server, server_address, processes, timeout = None):
+    """Serve from `processes` forked worker processes, and supervise them until told to stop.
+
+       `create_server` is called in each worker with a listening socket
+       and a `reuse_port` flag, and must return a server object. Where
+       the platform supports SO_REUSEPORT, each worker binds its own
+       socket to `server_address`, and the socket argument is None.
+       Otherwise, all workers share a socket bound by the parent.
+
+       Workers that exit are restarted, up to WORKER_RESTART_LIMIT times
+       within WORKER_RESTART_WINDOW seconds. SIGTERM or SIGINT to the
+       parent, or `timeout` seconds having passed, shut down all workers
+       gracefully: they finish the requests they are handling, then
+       exit.
+
+       An OSError is raised if `server_address` can not be bound, and a
+       RuntimeError if a worker fails to create its server or workers
+       have to be restarted too often.
+    """
+
+    if not hasattr(os, "fork"):
+
+        raise RuntimeError("Serving with several processes is not supported on this platform.")
+
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+
+    listening_socket = None
+
+    if reuse_port:
+
+        # Workers bind after the fork. Bind once here, so that an
+        # address in use is reported to the caller rather than to each
+        # worker.
+        #
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as test_socket:
+
+            test_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+            test_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+            test_socket.bind(server_address)
+
+    else:
+
+        listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        listening_socket.bind(server_address)
+
+        listening_socket.listen(socketserver.TCPServer.request_queue_size)
+
+    stopping = [False]
+
+    def request_stop(signum, frame):
+
+        stopping[0] = True
+
+        return
+
+    def start_worker():
+
+        sys.stderr.flush()
+
+        pid = os.fork()
+
+        if pid:
+
+            return pid
+
+        # Worker process from here on
+        #
+        exit_status = 0
+
+        try:
+            try:
+                server = create_server(listening_socket, reuse_port)
+
+            except BaseException:
+
+                LOGGER.exception("Worker process %s could not start", os.getpid())
+
+                exit_status = WORKER_STARTUP_FAILED
+
+                raise
+
+            # shutdown() waits for serve_forever() to return, so it must
+            # not be called from the signal handler, which runs in the
+            # serving thread.
+            #
+            signal.signal(signal.SIGTERM,
+                          lambda signum, frame: threading.Thread(target = server.shutdown).start())
+
+            # Interrupts are handled by the parent
+            #
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+            if not stopping[0]:
+
+                try:
+                    server.serve_forever()
+
+                finally:
+
+                    server.server_close()
+
+        except BaseException:
+
+            if exit_status == 0:
+
+                LOGGER.exception("Worker process %s failed", os.getpid())
+
+                exit_status = 1
+
+        finally:
+
+            sys.stderr.flush()
+
+            os._exit(exit_status)
+
+    install_handlers = threading.current_thread() is threading.main_thread()
+
+    if install_handlers:
+
+        original_handlers = {signal.SIGTERM: signal.signal(signal.SIGTERM, request_stop),
+                             signal.SIGINT: signal.signal(signal.SIGINT, request_stop)}
+
+    # Maps worker process IDs to their start times
+    #
+    workers = {}
+
+    # Times of recent restarts
+    #
+    restart_times = collections.deque()
+
+    deadline = None
+
+    if timeout is not None:
+
+        deadline = time.monotonic() + timeout
+
+    try:
+        for index in range(processes):
+
+            workers[start_worker()] = time.monotonic()
+
+        LOGGER.info("Started %s worker processes", processes)
+
+        while not stopping[0] and (deadline is None or time.monotonic() < deadline):
+
+            time.sleep(0.1)
+
+            for pid in list(workers.keys()):
+
+                waited_pid, wait_status = os.waitpid(pid, os.WNOHANG)
+
+                if waited_pid == 0:
+
+                    continue
+
+                start_time = workers.pop(pid)
+
+                if os.waitstatus_to_exitcode(wait_status) == WORKER_STARTUP_FAILED:
+
+                    raise RuntimeError("Worker process {} could not start, see the log for details.".format(pid))
+
+                now = time.monotonic()
+
+                while restart_times and now - restart_times[0] > WORKER_RESTART_WINDOW:
+
+                    restart_times.popleft()
+
+                if len(restart_times) >= WORKER_RESTART_LIMIT:
+
+                    raise RuntimeError("Worker processes exited {} times within {} seconds, giving up.".format(len(restart_times) + 1, WORKER_RESTART_WINDOW))
+
+                restart_times.append(now)
+
+                LOGGER.warning("Worker process %s exited, restarting", pid)
+
+                # Do not spin if workers fail right away
+                #
+                if time.monotonic() - start_time < 1.0:
+
+                    time.sleep(1.0)
+
+                workers[start_worker()] = time.monotonic()
+
+    finally:
+
+        LOGGER.info("Stopping %s worker processes", len(workers))
+
+        for pid in workers.keys():
+
+            try:
+                os.kill(pid, signal.SIGTERM)
+
+            except ProcessLookupError:
+
+                pass
+
+        for pid in workers.keys():
+
+            os.waitpid(pid, 0)
+
+        if install_handlers:
+
+            for signum in original_handlers.keys():
+
+                signal.signal(signum, original_handlers[signum])
+
+        if listening_socket is not None:
+
+            listening_socket.close()
+
+    return
+
+class InstrumentedHandlerMixin:
+    """Mixin for http.server request handlers, recording request metrics and logging requests via the logging module.
+
+       Every request is timed with the "http_request" timer, and counted
+       by status class as "http_responses_2xx" etc. If the server has a
+       `metrics_path`, GET requests for it are answered with the metrics
+       of this process, in the Prometheus text format or, with the query
+       "format=json", as JSON.
+    """
+
+    def handle_one_request(self):
+        """BaseHTTPRequestHandler standard method: handle one request, and record its duration.
+        """
+
+        self.response_status = None
+
+        start_time = time.perf_counter()
+
+        super().handle_one_request()
+
+        if self.response_status is not None:
+
+            METRICS.observe("http_request", time.perf_counter() - start_time)
+
+            METRICS.count("http_responses_{}xx".format(self.response_status // 100))
+
+        return
+
+    def log_request(self, code = "-", size = "-"):
+        """BaseHTTPRequestHandler standard method: note the response status, and log the request.
+        """
+
+        if isinstance(code, int):
+
+            self.response_status = int(code)
+
+        if ACCESS_LOGGER.isEnabledFor(logging.INFO):
+
+            ACCESS_LOGGER.info('%s "%s" %s %s', self.address_string(), self.requestline, str(code), str(size))
+
+        return
+
+    def log_error(self, format, *args):
+        """BaseHTTPRequestHandler standard method: log an error response, like a request.
+        """
+
+        if ACCESS_LOGGER.isEnabledFor(logging.INFO):
+
+            ACCESS_LOGGER.info("%s: %s", self.address_string(), format % args)
+
+        return
+
+    def log_message(self, format, *args):
+        """BaseHTTPRequestHandler standard method: log a message at debug level.
+        """
+
+        LOGGER.debug("%s: %s", self.address_string(), format % args)
+
+        return
+
+    def send_metrics(self, head_only):
+        """Answer the request with the metrics of this process, if it asks for the server's `metrics_path`.
+
+           Returns True if the request has been answered.
+        """
+
+        metrics_path = getattr(self.server, "metrics_path", None)
+
+        split_uri = urllib.parse.urlsplit(self.path)
+
+        if metrics_path is None or split_uri.path != metrics_path:
+
+            return False
+
+        if urllib.parse.parse_qs(split_uri.query).get("format") == ["json"]:
+
+            content_type = "application/json"
+
+            body = METRICS.to_json().encode("utf8")
+
+        else:
+
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+            body = METRICS.to_text().encode("utf8")
+
+        self.send_response(200)
+
+        self.send_header("Content-type", content_type)
+
+        self.send_header("Content-Length", str(len(body)))
+
+        self.send_header("Cache-Control", "no-store")
+
+        self.end_headers()
+
+        if not head_only:
+
+            self.wfile.write(body)
+
+        return True
+
+class PycmsHTTPRequestHandler(InstrumentedHandlerMixin, http.server.SimpleHTTPRequestHandler):
+    """Request handler serving the files of a pycms instance, with HTTP/1.1 keep-alive.
+
+       The files are served from the server's `document_root`, not from
+       the current working directory. Path components starting with an
+       underscore or a dot are pycms internals and are not served.
+
+       If the server has a `page_cache`, files are answered from it as
+       long as they are unchanged on disk. Files held in memory are
+       served with strong ETags, and conditional requests are answered
+       with 304 Not Modified where possible.
+
+       If the server has a `renderer`, pages are taken from it instead
+       of being read from their files, where possible.
+
+       Requests are instrumented as described in InstrumentedHandlerMixin.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    timeout = KEEP_ALIVE_TIMEOUT
+
+    # Headers and body are sent in separate writes. With Nagle's
+    # algorithm, the body would wait for the client's delayed ACK on
+    # every request of a keep-alive connection.
+    #
+    disable_nagle_algorithm = True
+
+    def __init__(self, request, client_address, server):
+        """Initialise, serving from `server.document_root`.
+        """
+
+        http.server.SimpleHTTPRequestHandler.__init__(self,
+                                                      request,
+                                                      client_address,
+                                                      server,
+                                                      directory = server.document_root)
+
+        return
+
+    def do_GET(self):
+        """BaseHTTPRequestHandler standard method: handle a GET request.
+        """
+
+        if self.send_metrics(head_only = False):
+
+            return
+
+        if not self.send_page(head_only = False):
+
+            http.server.SimpleHTTPRequestHandler.do_GET(self)
+
+        return
+
+    def do_HEAD(self):
+        """BaseHTTPRequestHandler standard method: handle a HEAD request.
+        """
+
+        if self.send_metrics(head_only = True):
+
+            return
+
+        if not self.send_page(head_only = True):
+
+            http.server.SimpleHTTPRequestHandler.do_HEAD(self)
+
+        return
+
+    def is_hidden(self):
+        """Return True if the requested path must not be served.
+        """
+
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+
+        return any(component.startswith(("_", ".")) for component in path.split("/"))
+
+    def send_page(self, head_only):
+        """Answer the request with a file, held in memory using the page cache if there is one.
+
+           Supports conditional requests using ETag and Last-Modified
+           validators, and sets the Cache-Control header configured for
+           the request path.
+
+           Returns False if the request can not be answered this way,
+           e.g. for directory redirects or missing files, in which case
+           the caller should fall back to the default handling.
+        """
+
+        if self.is_hidden():
+
+            return False
+
+        if self.server.renderer is not None and self.send_rendered(head_only):
+
+            return True
+
+        path = self.translate_path(self.path)
+
+        if path.endswith("/"):
+
+            path = os.path.join(path, "index.html")
+
+        try:
+            stat_result = os.stat(path)
+
+        except OSError:
+
+            return False
+
+        if not os.path.isfile(path):
+
+            return False
+
+        path = os.path.normpath(path)
+
+        content_type = None
+
+        encoding = None
+
+        if self.accepts_gzip():
+
+            # Prefer a precompressed copy, unless it is older than the
+            # file itself.
+            #
+            try:
+                compressed_stat_result = os.stat(path + ".gz")
+
+                if compressed_stat_result.st_mtime_ns >= stat_result.st_mtime_ns:
+
+                    content_type = self.guess_type(path)
+
+                    encoding = "gzip"
+
+                    path = path + ".gz"
+
+                    stat_result = compressed_stat_result
+
+            except OSError:
+
+                pass
+
+        signature = (stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size)
+
+        page_cache = self.server.page_cache
+
+        cached = None
+
+        if page_cache is not None:
+
+            cached = page_cache.get(path, signature)
+
+        if cached is None:
+
+            headers = {"Content-type": content_type or self.guess_type(path),
+                       "Last-Modified": self.date_time_string(stat_result.st_mtime),
+                       "Vary": "Accept-Encoding",
+                       "Accept-Ranges": "bytes"}
+
+            if encoding is not None:
+
+                headers["Content-Encoding"] = encoding
+
+            if stat_result.st_size > (page_cache.max_bytes // 4 if page_cache is not None else INLINE_LIMIT):
+
+                # Too large to be held in memory. Hand the file to the
+                # kernel instead, and derive the ETag from the file's
+                # signature rather than reading it.
+                #
+                try:
+                    large_file = open(path, "rb")
+
+                except OSError:
+
+                    return False
+
+                headers["ETag"] = '"{:x}-{:x}"'.format(stat_result.st_mtime_ns, stat_result.st_size)
+
+                try:
+                    return self.send_entity(headers,
+                                            stat_result.st_mtime,
+                                            stat_result.st_size,
+                                            head_only,
+                                            lambda start, length: self.connection.sendfile(large_file, start, length))
+
+                finally:
+
+                    large_file.close()
+
+            try:
+                with open(path, "rb") as page_file:
+
+                    body = page_file.read()
+
+            except OSError:
+
+                return False
+
+            headers["ETag"] = '"{}"'.format(page_hash(path, stat_result, body))
+
+            if page_cache is not None:
+
+                page_cache.put(path, signature, body, headers)
+
+        else:
+
+            body, headers = cached
+
+        return self.send_entity(headers,
+                                stat_result.st_mtime,
+                                len(body),
+                                head_only,
+                                lambda start, length: self.wfile.write(body[start:start + length]))
+
+    def send_rendered(self, head_only):
+        """Answer the request with a page from the server's `renderer`.
+
+           Returns False if the request is not for a page, or if the
+           page can not be rendered.
+        """
+
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+
+        if path.endswith("/" + pycms.PAGE_FILE):
+
+            path = path[:-len(pycms.PAGE_FILE)]
+
+        if not path.endswith("/"):
+
+            # Left to the default handling, which redirects directories
+            #
+            return False
+
+        rendered = self.server.renderer.render("/" + path.strip("/"),
+                                               encoding = "gzip" if self.accepts_gzip() else None)
+
+        if rendered is None:
+
+            return False
+
+        body, etag, mtime, encoding = rendered
+
+        headers = {"Content-type": self.guess_type(pycms.PAGE_FILE),
+                   "Last-Modified": self.date_time_string(mtime),
+                   "Vary": "Accept-Encoding",
+                   "Accept-Ranges": "bytes",
+                   "ETag": '"{}"'.format(etag)}
+
+        if encoding is not None:
+
+            headers["Content-Encoding"] = encoding
+
+        return self.send_entity(headers,
+                                mtime,
+                                len(body),
+                                head_only,
+                                lambda start, length: self.wfile.write(body[start:start + length]))
+
+    def send_entity(self, headers, mtime, size, head_only, write_body):
+        """Send a response for an entity of `size` bytes with the given headers, honouring conditional and range requests.
+
+           `write_body` is called with the start offset and length of
+           the bytes to send.
+
+           Returns True.
+        """
+
+        cache_control = self.cache_control()
+
+        if self.not_modified(headers["ETag"], mtime):
+
+            self.send_response(http.HTTPStatus.NOT_MODIFIED)
+
+            self.send_header("ETag", headers["ETag"])
+
+            self.send_header("Last-Modified", headers["Last-Modified"])
+
+            self.send_header("Vary", "Accept-Encoding")
+
+            if cache_control is not None:
+
+                self.send_header("Cache-Control", cache_control)
+
+            self.end_headers()
+
+            return True
+
+        byte_range = self.requested_range(headers["ETag"], headers["Last-Modified"], size)
+
+        if byte_range is False:
+
+            self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+
+            self.send_header("Content-Range", "bytes */{}".format(size))
+
+            self.send_header("Content-Length", "0")
+
+            self.end_headers()
+
+            return True
+
+        if byte_range is None:
+
+            self.send_response(http.HTTPStatus.OK)
+
+            start, length = 0, size
+
+        else:
+
+            self.send_response(http.HTTPStatus.PARTIAL_CONTENT)
+
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(byte_range[0], byte_range[1], size))
+
+            start, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+
+        for name, value in headers.items():
+
+            self.send_header(name, value)
+
+        self.send_header("Content-Length", str(length))
+
+        if cache_control is not None:
+
+            self.send_header("Cache-Control", cache_control)
+
+        self.end_headers()
+
+        if not head_only and length:
+
+            write_body(start, length)
+
+        return True
+
+    def requested_range(self, etag, last_modified, size):
+        """Return the (first, last) byte positions requested by a Range header, None to send the whole entity, or False if the range can not be satisfied.
+
+           Only single byte ranges are supported. Requests for several
+           ranges are answered with the whole entity.
+        """
+
+        range_header = self.headers.get("Range")
+
+        if range_header is None:
+
+            return None
+
+        if_range = self.headers.get("If-Range")
+
+        if if_range is not None and if_range.strip() not in (etag, last_modified):
+
+            # The client's copy is outdated
+            #
+            return None
+
+        unit, separator, ranges = range_header.partition("=")
+
+        if unit.strip().lower() != "bytes" or "," in ranges:
+
+            return None
+
+        first, separator, last = ranges.strip().partition("-")
+
+        # Malformed ranges, e.g. with signs or blanks in the positions,
+        # are ignored
+        #
+        if not separator:
+
+            return None
+
+        for position in (first, last):
+
+            if position and not (position.isascii() and position.isdigit()):
+
+                return None
+
+        if first == "":
+
+            # Suffix range: the last bytes of the entity
+            #
+            if last == "":
+
+                return None
+
+            suffix_length = int(last)
+
+            if suffix_length == 0 or size == 0:
+
+                return False
+
+            return (max(0, size - suffix_length), size - 1)
+
+        first = int(first)
+
+        if last == "":
+
+            last = size - 1
+
+        else:
+
+            last = int(last)
+
+            if last < first:
+
+                return None
+
+        if first >= size:
+
+            return False
+
+        return (first, min(last, size - 1))
+
+    def accepts_gzip(self):
+        """Return True if the request's Accept-Encoding header allows a gzip encoded response.
+        """
+
+        accept_encoding = self.headers.get("Accept-Encoding")
+
+        if accept_encoding is None:
+
+            return False
+
+        for coding in accept_encoding.split(","):
+
+            name, separator, parameters = coding.partition(";")
+
+            if name.strip().lower() not in ("gzip", "*"):
+
+                continue
+
+            quality = 1.0
+
+            for parameter in parameters.split(";"):
+
+                key, separator, value = parameter.partition("=")
+
+                if key.strip().lower() == "q":
+
+                    try:
+                        quality = float(value)
+
+                    except ValueError:
+
+                        quality = 0.0
+
+            return quality > 0.0
+
+        return False
+
+    def not_modified(self, etag, mtime):
+        """Return True if the request's If-None-Match or If-Modified-Since header allows a 304 response.
+        """
+
+        if_none_match = self.headers.get("If-None-Match")
+
+        if if_none_match is not None:
+
+            # If-None-Match uses the weak comparison, and takes
+            # precedence over If-Modified-Since.
+            #
+            if if_none_match.strip() == "*":
+
+                return True
+
+            for tag in if_none_match.split(","):
+
+                tag = tag.strip()
+
+                if tag.startswith("W/"):
+
+                    tag = tag[2:]
+
+                if tag == etag:
+
+                    return True
+
+            return False
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+
+        if if_modified_since is not None:
+
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+
+            except (TypeError, ValueError, IndexError, OverflowError):
+
+                return False
+
+            if since.tzinfo is None:
+
+                return False
+
+            # HTTP dates have a resolution of one second
+            #
+            return int(mtime) <= since.timestamp()
+
+        return False
+
+    def cache_control(self):
+        """Return the Cache-Control header value for the request path, or None.
+
+           The value is looked up in the server's `cache_control` dict,
+           using the longest matching path prefix.
+        """
+
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+
+        best_prefix = None
+
+        for prefix in self.server.cache_control.keys():
+
+            if path.startswith(prefix) and (best_prefix is None or len(prefix) > len(best_prefix)):
+
+                best_prefix = prefix
+
+        if best_prefix is None:
+
+            return None
+
+        return self.server.cache_control[best_prefix]
+
+    def send_head(self):
+        """SimpleHTTPRequestHandler standard method: refuse hidden paths, then send the response header.
+        """
+
+        if self.is_hidden():
+
+            self.send_error(http.HTTPStatus.NOT_FOUND, "File not found")
+
+            return None
+
+        return http.server.SimpleHTTPRequestHandler.send_head(self)
@@ -0,0 +1,703 @@
+"""Benchmarks for pycms.
+
+   Copyright (c) 2013 Florian Berger <fberger@florian-berger.de>
+"""
+
+# This file is part of pycms.
+#
+# pycms is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# pycms is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with pycms.  If not, see <http://www.gnu.org/licenses/>.
+
+import optparse
+import pycms
+import pycms.server
+import pycmscmd
+import threading
+import http.client
+import tempfile
+import shutil
+import time
+import json
+import sys
+import os
+import logging
+
+# Default shape of generated instances
+#
+SHAPE = {"pages": 1000,
+         "depth": 3,
+         "templates": 4,
+         "placeholders": 8,
+         "page_bytes": 16 * 1024}
+
+def make_template(placeholders, lines_per_separator):
+    """Return a template string with `placeholders` placeholder lines, separated by `lines_per_separator` lines of markup.
+    """
+
+    lines = ["<!DOCTYPE html>\n", "<html>\n"]
+
+    for index in range(placeholders):
+
+        for line_number in range(lines_per_separator):
+
+            lines.append('    <div class="section-{}-{}">Some static template text</div>\n'.format(index, line_number))
+
+        lines.append("    PLACEHOLDER_{}\n".format(placeholder_name(index)))
+
+    lines.append("</html>\n")
+
+    return "".join(lines)
+
+def placeholder_name(index):
+    """Return an uppercase placeholder name for `index`.
+    """
+
+    name = ""
+
+    index += 1
+
+    while index:
+
+        index, remainder = divmod(index - 1, 26)
+
+        name = chr(65 + remainder) + name
+
+    return name
+
+def best_of(repeat, function, *args):
+    """Call `function(*args)` `repeat` times, and return the best wall clock time in seconds.
+    """
+
+    best = None
+
+    for iteration in range(repeat):
+
+        start_time = time.perf_counter()
+
+        function(*args)
+
+        duration = time.perf_counter() - start_time
+
+        if best is None or duration < best:
+
+            best = duration
+
+    return best
+
+def lines_for_size(placeholders, page_bytes):
+    """Return the number of lines per separator that makes a template of `placeholders` placeholders about `page_bytes` bytes large.
+    """
+
+    # make_template() writes about 60 bytes per line
+    #
+    return max(1, page_bytes // (60 * (placeholders + 1)))
+
+def fill_template(template, page_index):
+    """Return a page for `template`, with every placeholder line replaced by a line of content.
+    """
+
+    return template.replace("PLACEHOLDER_", "<p>Content of page {} for ".format(page_index))
+
+def generate_uris(pages, depth):
+    """Return a list of `pages` distinct URIs, each `depth` path components deep.
+    """
+
+    fanout = 2
+
+    while fanout ** depth < pages:
+
+        fanout += 1
+
+    uris = []
+
+    for index in range(pages):
+
+        components = []
+
+        remainder = index
+
+        for level in range(depth):
+
+            remainder, digit = divmod(remainder, fanout)
+
+            components.insert(0, "n{}".format(digit))
+
+        uris.append("/" + "/".join(components))
+
+    return uris
+
+def generate_instance(htmlroot, pages, depth, templates, placeholders, page_bytes):
+    """Create a pycms instance in `htmlroot` with the given shape, and return it.
+
+       `templates` templates with `placeholders` placeholders each, of
+       about `page_bytes` bytes, are used by `pages` pages in turn. The
+       pages are nested `depth` levels deep.
+    """
+
+    instance = pycms.Instance(htmlroot)
+
+    instance.envinit()
+
+    template_sources = []
+
+    for index in range(templates):
+
+        template_sources.append(make_template(placeholders, lines_for_size(placeholders, page_bytes)))
+
+        with open(os.path.join(htmlroot, pycms.TEMPLATES_FOLDER, "template_{}.html".format(index)), "wt", encoding = "utf8") as template_file:
+
+            template_file.write(template_sources[-1])
+
+    instance.create_pages([(uri,
+                            "template_{}.html".format(index % templates),
+                            fill_template(template_sources[index % templates], index))
+                           for index, uri in enumerate(generate_uris(pages, depth))])
+
+    return instance
+
+def bench_replace(instance, shape, options):
+    """Time applying the replacements of all pages to a template.
+
+       Compares one str.replace() call per placeholder, as pycms did
+       before, with LineReplacement.replace() using a template compiled
+       once for all pages.
+    """
+
+    template = make_template(shape["placeholders"], lines_for_size(shape["placeholders"], shape["page_bytes"]))
+
+    replacement = pycms.LineReplacement.__new__(pycms.LineReplacement)
+
+    replacement.replacements = dict(("PLACEHOLDER_{}".format(placeholder_name(index)),
+                                     "<p>Content for placeholder {}</p>".format(index))
+                                    for index in range(shape["placeholders"]))
+
+    def sequential():
+
+        for page in range(shape["pages"]):
+
+            result = template
+
+            for key in replacement.replacements.keys():
+
+                result = result.replace(key, replacement.replacements[key])
+
+    def compiled():
+
+        compiled_template = pycms.LineReplacement.compile(template, replacement.replacements.keys())
+
+        for page in range(shape["pages"]):
+
+            replacement.replace(template, compiled = compiled_template)
+
+    return {"template_bytes": len(template),
+            "sequential_seconds": best_of(options.repeat, sequential),
+            "compiled_seconds": best_of(options.repeat, compiled)}
+
+def bench_diff(instance, shape, options):
+    """Time extracting the placeholder contents from pages, i.e. creating LineReplacement objects.
+    """
+
+    pairs = []
+
+    for template in instance.templates.names():
+
+        with open(os.path.join(instance.htmlroot, pycms.TEMPLATES_FOLDER, template), "rt", encoding = "utf8") as template_file:
+
+            source = template_file.read()
+
+        for uri in instance.uri_map.uris_for_template(template)[:options.operations]:
+
+            with open(instance._page_path(uri), "rt", encoding = "utf8") as page_file:
+
+                pairs.append((source, page_file.read()))
+
+    def diff():
+
+        for source, page in pairs:
+
+            pycms.LineReplacement(source, page)
+
+    def diff_tokenised():
+
+        tokenised = {}
+
+        for source, page in pairs:
+
+            if source not in tokenised:
+
+                tokenised[source] = pycms.LineReplacement.tokenise(source)
+
+            pycms.LineReplacement(source, page, tokenised = tokenised[source])
+
+    return {"pages_diffed": len(pairs),
+            "seconds": best_of(options.repeat, diff),
+            "tokenised_seconds": best_of(options.repeat, diff_tokenised)}
+
+def bench_create_page(instance, shape, options):
+    """Time creating pages one by one with Instance.create_page().
+    """
+
+    best = None
+
+    for iteration in range(options.repeat):
+
+        instance.create_page("/bench", "template_0.html")
+
+        start_time = time.perf_counter()
+
+        for index in range(options.operations):
+
+            instance.create_page("/bench/{}".format(index), "template_0.html")
+
+        duration = time.perf_counter() - start_time
+
+        instance.remove_page("/bench", recursive = True)
+
+        if best is None or duration < best:
+
+            best = duration
+
+    return {"operations": options.operations,
+            "seconds": best,
+            "seconds_per_operation": best / options.operations}
+
+def bench_remove_page(instance, shape, options):
+    """Time removing pages one by one with Instance.remove_page().
+    """
+
+    best = None
+
+    uris = ["/bench/{}".format(index) for index in range(options.operations)]
+
+    for iteration in range(options.repeat):
+
+        instance.create_pages([(uri, "template_0.html") for uri in ["/bench"] + uris])
+
+        start_time = time.perf_counter()
+
+        for uri in uris:
+
+            instance.remove_page(uri)
+
+        duration = time.perf_counter() - start_time
+
+        instance.remove_page("/bench")
+
+        if best is None or duration < best:
+
+            best = duration
+
+    return {"operations": options.operations,
+            "seconds": best,
+            "seconds_per_operation": best / options.operations}
+
+def bench_update(instance, shape, options):
+    """Time Instance.update() after an edit of the first template.
+    """
+
+    template_path = os.path.join(instance.htmlroot, pycms.TEMPLATES_FOLDER, "template_0.html")
+
+    best = None
+
+    for iteration in range(options.repeat):
+
+        instance.edit_template("template_0.html")
+
+        with open(template_path, "at", encoding = "utf8") as template_file:
+
+            template_file.write("<!-- Edit {} -->\n".format(iteration))
+
+        start_time = time.perf_counter()
+
+        failures = instance.update(workers = options.workers)
+
+        duration = time.perf_counter() - start_time
+
+        if failures:
+
+            raise RuntimeError("{} page(s) failed to update".format(len(failures)))
+
+        if best is None or duration < best:
+
+            best = duration
+
+    return {"pages_updated": instance.uri_map.count_for_template("template_0.html"),
+            "workers": options.workers,
+            "seconds": best}
+
+def bench_publish(instance, shape, options):
+    """Time Instance.publish(), hard-linking all pages into a new generation.
+    """
+
+    seconds = best_of(options.repeat, instance.publish)
+
+    return {"generations_kept": pycms.GENERATIONS_KEPT,
+            "seconds": seconds}
+
+def bench_list(instance, shape, options):
+    """Time the 'list' command of pycmscmd.py, for the whole map and for a single page of it.
+    """
+
+    command = pycmscmd.PycmsCmd(instance)
+
+    stdout = sys.stdout
+
+    sys.stdout = open(os.devnull, "wt")
+
+    try:
+        full_seconds = best_of(options.repeat, command.onecmd, "list")
+
+        page_seconds = best_of(options.repeat, command.onecmd, "list --offset {} --limit 100".format(shape["pages"] // 2))
+
+    finally:
+
+        sys.stdout.close()
+
+        sys.stdout = stdout
+
+    return {"full_seconds": full_seconds,
+            "page_seconds": page_seconds}
+
+def bench_complete(instance, shape, options):
+    """Time tab completion in pycmscmd.py, for partial URIs at every nesting level.
+    """
+
+    command = pycmscmd.PycmsCmd(instance)
+
+    texts = ["", "/n"]
+
+    for uri in instance.uri_map.uris()[1:options.operations]:
+
+        texts.append(uri.rpartition("/")[0] + "/")
+
+    def complete():
+
+        for text in texts:
+
+            command.completedefault(text, "create_page " + text, 12, 12 + len(text))
+
+    seconds = best_of(options.repeat, complete)
+
+    return {"completions": len(texts),
+            "seconds": seconds,
+            "seconds_per_completion": seconds / len(texts)}
+
+def bench_serve(instance, shape, options):
+    """Measure the request throughput of the pycms server, with clients using keep-alive connections.
+    """
+
+    return measure_throughput(instance, options)
+
+def bench_serve_render(instance, shape, options):
+    """Measure the request throughput of the pycms server rendering pages on request, and the time for a template edit to be served.
+    """
+
+    renderer = pycms.CMS(instance.htmlroot, instance = instance)
+
+    result = measure_throughput(instance, options, renderer = renderer)
+
+    template_path = os.path.join(instance.htmlroot, pycms.TEMPLATES_FOLDER, "template_0.html")
+
+    uri = instance.uri_map.uris_for_template("template_0.html")[0]
+
+    with open(template_path, "rb") as template_file:
+
+        template = template_file.read()
+
+    best = None
+
+    try:
+        for iteration in range(options.repeat):
+
+            start_time = time.perf_counter()
+
+            with open(template_path, "at", encoding = "utf8") as template_file:
+
+                template_file.write("<!-- Edit {} -->\n".format(iteration))
+
+            rendered = renderer.render(uri)
+
+            duration = time.perf_counter() - start_time
+
+            if rendered is None or "<!-- Edit {} -->".format(iteration) not in rendered[0].decode("utf8"):
+
+                raise RuntimeError("Template edit not rendered for '{}'".format(uri))
+
+            if best is None or duration < best:
+
+                best = duration
+
+    finally:
+
+        # Leave the template as the pages expect it
+        #
+        with open(template_path, "wb") as template_file:
+
+            template_file.write(template)
+
+    result["template_edit_seconds"] = best
+
+    result["render_cache"] = renderer.render_cache.stats()
+
+    return result
+
+def bench_serve_preload(instance, shape, options):
+    """Measure the request throughput of the pycms server answering from an in-memory routing table, and the time to load the table.
+    """
+
+    cms = pycms.CMS(instance.htmlroot, cache_bytes = 0, instance = instance)
+
+    start_time = time.perf_counter()
+
+    pycms.envparse(instance.htmlroot, cms)
+
+    load_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+
+    pycms.envparse(instance.htmlroot, cms)
+
+    reload_seconds = time.perf_counter() - start_time
+
+    result = measure_throughput(instance, options, renderer = cms.routes)
+
+    result["load_seconds"] = load_seconds
+
+    result["reload_seconds"] = reload_seconds
+
+    return result
+
+def measure_throughput(instance, options, renderer = None):
+    """Return a dict with the request throughput of a pycms server for `instance`, rendering pages with `renderer` if given.
+    """
+
+    page_cache = pycms.server.PageCache(64 * 1024 * 1024)
+
+    server = pycms.server.ThreadPoolHTTPServer(("127.0.0.1", 0),
+                                               pycms.server.PycmsHTTPRequestHandler,
+                                               instance.htmlroot,
+                                               threads = options.threads,
+                                               page_cache = page_cache,
+                                               renderer = renderer)
+
+    server_thread = threading.Thread(target = server.serve_forever)
+
+    server_thread.start()
+
+    uris = [uri.rstrip("/") + "/" for uri in instance.uri_map.uris()]
+
+    requests_per_client = max(1, options.requests // options.clients)
+
+    errors = []
+
+    def client(client_index):
+
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+
+        try:
+            for index in range(requests_per_client):
+
+                connection.request("GET", uris[(client_index * requests_per_client + index) % len(uris)])
+
+                response = connection.getresponse()
+
+                response.read()
+
+                if response.status != 200:
+
+                    errors.append(response.status)
+
+        finally:
+
+            connection.close()
+
+        return
+
+    try:
+        start_time = time.perf_counter()
+
+        clients = [threading.Thread(target = client, args = (index,)) for index in range(options.clients)]
+
+        for client_thread in clients:
+
+            client_thread.start()
+
+        for client_thread in clients:
+
+            client_thread.join()
+
+        duration = time.perf_counter() - start_time
+
+    finally:
+
+        server.shutdown()
+
+        server_thread.join()
+
+        server.server_close()
+
+    total = requests_per_client * options.clients
+
+    return {"requests": total,
+            "clients": options.clients,
+            "threads": options.threads,
+            "errors": len(errors),
+            "seconds": duration,
+            "requests_per_second": total / duration,
+            "cache": page_cache.stats()}
+
+# Benchmarks in the order they are run. Those changing the instance
+# come last.
+#
+BENCHMARKS = [("replace", bench_replace),
+              ("diff", bench_diff),
+              ("list", bench_list),
+              ("complete", bench_complete),
+              ("serve", bench_serve),
+              ("serve_render", bench_serve_render),
+              ("serve_preload", bench_serve_preload),
+              ("create_page", bench_create_page),
+              ("remove_page", bench_remove_page),
+              ("update", bench_update),
+              ("publish", bench_publish)]
+
+def main():
+    """Generate an instance, run benchmarks on it and print the results as JSON lines.
+    """
+
+    parser = optparse.OptionParser(version = pycms.VERSION,
+                                   usage = "Usage: %prog [options] [benchmark ...]\n\nBenchmarks: {}".format(", ".join(name for name, function in BENCHMARKS)))
+
+    for key in sorted(SHAPE.keys()):
+
+        parser.add_option("--" + key.replace("_", "-"),
+                          action = "store",
+                          type = "int",
+                          dest = key,
+                          default = SHAPE[key],
+                          help = "Shape of the generated instance. Default: {}".format(SHAPE[key]))
+
+    parser.add_option("-r", "--repeat",
+                      action = "store",
+                      type = "int",
+                      default = 3,
+                      help = "Run each benchmark this many times and report the best. Default: 3")
+
+    parser.add_option("-o", "--operations",
+                      action = "store",
+                      type = "int",
+                      default = 100,
+                      help = "Number of pages created, removed, diffed or completed per run. Default: 100")
+
+    parser.add_option("-w", "--workers",
+                      action = "store",
+                      type = "int",
+                      default = 1,
+                      help = "Number of worker processes for update. Default: 1")
+
+    parser.add_option("--requests",
+                      action = "store",
+                      type = "int",
+                      default = 2000,
+                      help = "Number of requests sent to the server. Default: 2000")
+
+    parser.add_option("--clients",
+                      action = "store",
+                      type = "int",
+                      default = 4,
+                      help = "Number of concurrent clients sending requests. Default: 4")
+
+    parser.add_option("--threads",
+                      action = "store",
+                      type = "int",
+                      default = 10,
+                      help = "Number of server worker threads. Default: 10")
+
+    parser.add_option("-d", "--directory",
+                      action = "store",
+                      default = None,
+                      help = "Generate the instance in this directory and keep it. Default: a temporary directory")
+
+    options, args = parser.parse_args()
+
+    for key in ("repeat", "operations", "workers", "requests", "clients", "threads"):
+
+        if getattr(options, key) < 1:
+
+            parser.error("--{} must be at least 1".format(key))
+
+    benchmark_dict = dict(BENCHMARKS)
+
+    for name in args:
+
+        if name not in benchmark_dict:
+
+            parser.error("Unknown benchmark '{}'".format(name))
+
+    shape = dict((key, getattr(options, key)) for key in SHAPE.keys())
+
+    # Keep the warnings of pycms out of the results. Errors are still
+    # reported.
+    #
+    logging.getLogger("pycms").setLevel(logging.ERROR)
+
+    if options.directory is None:
+
+        temp_directory = tempfile.mkdtemp(prefix = "pycmsbench-")
+
+        htmlroot = os.path.join(temp_directory, "htmlroot")
+
+    else:
+
+        temp_directory = None
+
+        htmlroot = options.directory
+
+    try:
+        start_time = time.perf_counter()
+
+        instance = generate_instance(htmlroot, **shape)
+
+        generate_seconds = time.perf_counter() - start_time
+
+        for name, function in BENCHMARKS:
+
+            if args and name not in args:
+
+                continue
+
+            result = {"benchmark": name,
+                      "version": pycms.VERSION,
+                      "python": sys.version.split()[0],
+                      "repeat": options.repeat,
+                      "generate_seconds": generate_seconds}
+
+            result.update(shape)
+
+            result.update(function(instance, shape, options))
+
+            print(json.dumps(result, sort_keys = True))
+
+            sys.stdout.flush()
+
+    finally:
+
+        if temp_directory is not None:
+
+            shutil.rmtree(temp_directory)
+
+    return
+
+if __name__ == "__main__":
+
+    main()
@@ -21,9 +21,9 @@
 import optparse
 import pycms
 import cmd
-import glob
-import os.path
-import json
+import shlex
+import sys
+import logging
 
 # http://bugs.python.org/issue15074
 import readline
@@ -76,6 +76,53 @@ htmlroot = {}""".format(self.instance.htmlroot)
 
         return False
 
+    def do_create_pages(self, arg):
+        """Create pages listed in a file, or on stdin if no file is given: create_pages [file]
+
+           Each line holds a URI and a template, optionally followed by the
+           path to a file with the page content. Empty lines and lines
+           starting with '#' are ignored.
+        """
+
+        pages = []
+
+        if arg.strip() and arg.strip() != "-":
+
+            list_file = open(arg.strip(), "rt", encoding = "utf8")
+
+        else:
+
+            list_file = sys.stdin
+
+        try:
+            for line in list_file:
+
+                fields = line.split()
+
+                if not fields or fields[0].startswith("#"):
+
+                    continue
+
+                if len(fields) > 2:
+
+                    with open(fields[2], "rt", encoding = "utf8") as content_file:
+
+                        fields[2] = content_file.read()
+
+                pages.append(tuple(fields[:3]))
+
+        finally:
+
+            if list_file is not sys.stdin:
+
+                list_file.close()
+
+        self.instance.create_pages(pages)
+
+        print("Created {} page(s).".format(len(pages)))
+
+        return False
+
     def do_edit_template(self, arg):
         """do_edit_template documentation
         """
@@ -85,18 +132,84 @@ htmlroot = {}""".format(self.instance.htmlroot)
         return False
 
     def do_update(self, arg):
-        """do_update documentation
+        """Apply pending template changes to all pages: update [-s] [--subtree URI] [--priority FILE] [workers]
+
+           -s publishes the pages as a new generation. --subtree limits
+           the update to the pages at and below URI, and --priority
+           names a file listing URIs to update first, one per line.
+        """
+
+        parser = optparse.OptionParser(prog = "update", add_help_option = False)
+
+        parser.add_option("-s", "--staged", action = "store_true", default = False)
+
+        parser.add_option("--subtree", default = None)
+
+        parser.add_option("--priority", default = None)
+
+        try:
+            options, args = parser.parse_args(shlex.split(arg))
+
+        except SystemExit:
+
+            # optparse has printed the error already
+            #
+            return False
+
+        workers = 1
+
+        if args:
+
+            workers = int(args[0])
+
+        priority = None
+
+        if options.priority is not None:
+
+            with open(options.priority, "rt", encoding = "utf8") as priority_file:
+
+                priority = [line.strip() for line in priority_file if line.strip()]
+
+        failures = self.instance.update(workers = workers,
+                                        staged = options.staged,
+                                        subtree = options.subtree,
+                                        priority = priority)
+
+        if failures:
+
+            print("{} page(s) failed to update.".format(len(failures)))
+
+        return False
+
+    def do_publish(self, arg):
+        """Publish the pages as a new generation, and serve it from now on.
+        """
+
+        print("Published generation {}.".format(self.instance.publish()))
+
+        return False
+
+    def do_rollback(self, arg):
+        """Serve the generation published before the current one again.
         """
 
-        self.instance.update()
+        print("Rolled back to generation {}.".format(self.instance.rollback()))
 
         return False
 
     def do_remove_page(self, arg):
-        """do_remove_page documentation
+        """Remove a page, and with -r all pages below it: remove_page [-r] uri
         """
 
-        self.instance.remove_page(arg)
+        args = arg.split()
+
+        recursive = "-r" in args
+
+        if recursive:
+
+            args.remove("-r")
+
+        self.instance.remove_page(" ".join(args), recursive = recursive)
 
         return False
 
@@ -108,73 +221,118 @@ htmlroot = {}""".format(self.instance.htmlroot)
 
         return False
 
-    def do_list(self, arg):
-        """Print a list of registeres URIs and associated templates.
+    def do_compress(self, arg):
+        """(Re)build the gzip compressed copies of all pages and static files.
         """
 
-        # TODO: Taken from Instance.create_page. Instead, the instance should provide a method to get the list.
+        print("Compressed {} file(s).".format(self.instance.compress()))
 
-        uri_map_dict = {}
+        return False
+
+    def do_compact(self, arg):
+        """Fold the URI map journal into a fresh snapshot of the map.
+        """
 
-        with open(os.path.join(self.instance.htmlroot, '_uri_template_map.json'), "rt", encoding = "utf8") as uri_map_file:
+        self.instance.uri_map.compact()
 
-            uri_map_dict = json.loads(uri_map_file.read())
+        return False
+
+    def do_metrics(self, arg):
+        """Print the counters and timers recorded in this session: metrics [json]
+        """
 
-        uris = list(uri_map_dict.keys())
+        if arg.strip() == "json":
 
-        uris.sort()
+            print(pycms.METRICS.to_json())
 
-        for uri in uris:
+        else:
 
-            print("{0}    [{1}]".format(uri, uri_map_dict[uri]))
+            print(pycms.METRICS.to_text(), end = "")
 
         return False
 
-    # End pycms.Instance method dispatchers
+    def do_migrate(self, arg):
+        """Move the URI map to another storage backend: migrate json|sqlite
+        """
 
-    def completedefault(self, text, line, begidx, endidx):
-        """Complete using the template file names and the instance file tree.
+        self.instance.migrate_uri_map(arg.strip())
+
+        return False
+
+    def do_list(self, arg):
+        """Print a list of registered URIs and associated templates: list [--prefix PREFIX | --subtree URI] [--template TEMPLATE] [--offset N] [--limit N]
         """
 
-        # TODO: A template file list really should be available in the instance.
-        #
-        template_paths = glob.glob("{}/_templates/*.html".format(self.instance.htmlroot))
+        parser = optparse.OptionParser(prog = "list", add_help_option = False)
+
+        parser.add_option("--prefix", default = "")
 
-        completions = [os.path.basename(path) for path in template_paths]
+        parser.add_option("--subtree", default = None)
 
-        uris = []
+        parser.add_option("--template", default = None)
 
-        for dirpath, dirnames, filenames in os.walk(self.instance.htmlroot, topdown = True):
+        parser.add_option("--offset", type = "int", default = 0)
 
-            # pycms URI path components are reflected by directories
-            # on disc, hence we're not interested in file names.
+        parser.add_option("--limit", type = "int", default = None)
 
-            # Remove pycms special directories.
-            # We have to manipulate the list in-place, but cannot
-            # iterate over it.
+        try:
+            options, args = parser.parse_args(shlex.split(arg))
+
+        except SystemExit:
+
+            # optparse has printed the error already
             #
-            index = 0
-            list_length = len(dirnames)
+            return False
 
-            while index < list_length:
+        offset = max(options.offset, 0)
 
-                if dirnames[index][0] == "_":
+        limit = None if options.limit is None else max(options.limit, 0)
 
-                    del dirnames[index]
+        if options.subtree is not None:
 
-                    list_length = len(dirnames)
+            uri_map = self.instance.uri_map
 
-                else:
+            items = [(uri, uri_map[uri]) for uri in uri_map.subtree(options.subtree)]
 
-                    index += 1
+            if options.template is not None:
 
-            # The part after the htmlroot perfectly resembles an URI
-            # component.
-            # TODO: Check on MS Windows
-            #
-            uris.append(dirpath.split(self.instance.htmlroot.strip("/"))[1])
+                items = [item for item in items if item[1] == options.template]
 
-        completions.extend(uris)
+            total = len(items)
+
+            items = items[offset:None if limit is None else offset + limit]
+
+        else:
+
+            total, items = self.instance.uri_map.list_items(prefix = options.prefix,
+                                                            template = options.template,
+                                                            offset = offset,
+                                                            limit = limit)
+
+        for uri, template in items:
+
+            print("{0}    [{1}]".format(uri, template))
+
+        if len(items) < total:
+
+            print("Listed {} of {} page(s).".format(len(items), total))
+
+        return False
+
+    # End pycms.Instance method dispatchers
+
+    def completedefault(self, text, line, begidx, endidx):
+        """Complete using the template file names and the registered URIs.
+        """
+
+        completions = self.instance.templates.names()
+
+        if text.startswith("/") or text == "":
+
+            # Only the next URI path component is completed, looked up
+            # in the trie of the URI map.
+            #
+            completions.extend(self.instance.uri_map.complete(text))
 
         if text != "":
 
@@ -197,17 +355,73 @@ def main():
     parser = optparse.OptionParser(version = pycms.VERSION,
                                    usage = "Usage: %prog [options] htmlroot [command [arguments]]")
 
-    # parser.add_option("-p", "--port",
-    #                   action = "store",
-    #                   type = "int",
-    #                   default = 8000,
-    #                   help = "The port to listen on. Default: 8000")
-
-    # parser.add_option("-t", "--threads",
-    #                   action = "store",
-    #                   type = "int",
-    #                   default = 10,
-    #                   help = "The number of worker threads to start. Default: 10")
+    parser.add_option("-b", "--bind",
+                      action = "store",
+                      type = "string",
+                      default = "",
+                      help = "The address to listen on. Default: all interfaces")
+
+    parser.add_option("-p", "--port",
+                      action = "store",
+                      type = "int",
+                      default = 8000,
+                      help = "The port to listen on. Default: 8000")
+
+    parser.add_option("-t", "--threads",
+                      action = "store",
+                      type = "int",
+                      default = 10,
+                      help = "The number of worker threads to start. Default: 10")
+
+    parser.add_option("-P", "--processes",
+                      action = "store",
+                      type = "int",
+                      default = 1,
+                      help = "The number of worker processes to fork. Default: 1")
+
+    parser.add_option("-c", "--cache-bytes",
+                      action = "store",
+                      type = "int",
+                      dest = "cache_bytes",
+                      default = 64 * 1024 * 1024,
+                      help = "The size of the in-memory page cache in bytes, 0 to disable. Default: 64 MiB")
+
+    parser.add_option("-j", "--journal",
+                      action = "store_true",
+                      dest = "journal",
+                      default = False,
+                      help = "Journal changes to the URI map instead of rewriting it. Default: Off.")
+
+    parser.add_option("-f", "--fsync",
+                      action = "store_true",
+                      dest = "fsync",
+                      default = False,
+                      help = "Flush all changes to the URI map to disk. Default: Off.")
+
+    parser.add_option("-m", "--metrics-path",
+                      action = "store",
+                      type = "string",
+                      dest = "metrics_path",
+                      default = None,
+                      help = "Serve metrics under this URI path, e.g. /metrics. Default: Off.")
+
+    parser.add_option("-v", "--verbose",
+                      action = "count",
+                      dest = "verbose",
+                      default = 0,
+                      help = "Log more. Given once, every served request is logged, twice, debug output as well.")
+
+    parser.add_option("-r", "--render",
+                      action = "store_true",
+                      dest = "render",
+                      default = False,
+                      help = "Render pages on request, so that template changes are served without an update. Default: Off.")
+
+    parser.add_option("-l", "--preload",
+                      action = "store_true",
+                      dest = "preload",
+                      default = False,
+                      help = "Load all pages into memory and serve them from there. Default: Off.")
 
     # parser.add_option("-a", "--autoreload",
     #                   action = "store_true",
@@ -215,6 +429,10 @@ def main():
     #                   default = False,
     #                   help = "Turn on CherryPy's auto reloading feature. Default: Off.")
 
+    # Options following the command belong to the command
+    #
+    parser.disable_interspersed_args()
+
     options, args = parser.parse_args()
 
     # # Conditionally turn off Autoreloader
@@ -223,9 +441,21 @@ def main():
 
     #     pycms.cherrypy.engine.autoreload.unsubscribe()
 
-    # pycms.CONFIG_DICT["global"]= {"server.socket_host" : "0.0.0.0",
-    #                               "server.socket_port" : options.port,
-    #                               "server.thread_pool" : options.threads}
+    pycms.CONFIG_DICT["global"]= {"server.socket_host" : options.bind,
+                                  "server.socket_port" : options.port,
+                                  "server.thread_pool" : options.threads,
+                                  "server.cache_bytes" : options.cache_bytes,
+                                  "server.processes" : options.processes,
+                                  "server.metrics_path" : options.metrics_path,
+                                  "server.render" : options.render,
+                                  "server.preload" : options.preload}
+
+    logging.basicConfig(format = "%(message)s",
+                        level = logging.DEBUG if options.verbose > 1 else logging.INFO)
+
+    if not options.verbose:
+
+        logging.getLogger("pycms.access").setLevel(logging.WARNING)
 
     if not len(args):
 
@@ -233,7 +463,9 @@ def main():
 
         raise SystemExit
 
-    instance = pycms.Instance(args[0])
+    instance = pycms.Instance(args[0],
+                              journal = options.journal,
+                              fsync = options.fsync)
     
     pycms_cmd = PycmsCmd(instance)
 
@@ -21,18 +21,15 @@
 # Work started on 30. August 2015
 
 import optparse
-from sys import stderr
+import logging
 import pycms
+import pycms.server
 import http.server
-import socketserver
-import urllib
-import quickhtml
-import cgi
+import urllib.parse
+import email.message
+import html
 import os.path
-# For listing URIs
-import json
-# For listing templates
-import glob
+import threading
 
 URI_HANDLERS = {}
 
@@ -40,6 +37,277 @@ URI_HANDLERS = {}
 #
 INSTANCE = [None]
 
+# Handlers run one at a time, as they share INSTANCE[0]. Parsing
+# request bodies and sending responses is done in parallel.
+#
+INSTANCE_LOCK = threading.Lock()
+
+LOGGER = logging.getLogger("pycms.webadmin")
+
+# URI path of the metrics of the web admin process
+#
+METRICS_PATH = "/metrics"
+
+# Maximum size of a request body, and of a single form field in it
+#
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+MAX_FIELD_BYTES = 8 * 1024 * 1024
+
+MAX_PART_HEADER_BYTES = 16 * 1024
+
+# Bytes to read from the client at a time
+#
+READ_CHUNK_BYTES = 64 * 1024
+
+# Default and maximum number of URIs listed on one admin page
+#
+ADMIN_PAGE_SIZE = 100
+
+ADMIN_MAX_PAGE_SIZE = 1000
+
+class RequestBodyError(RuntimeError):
+    """Raised if a request body can not be parsed. `status` is the HTTP status code to answer with.
+    """
+
+    def __init__(self, status, message):
+
+        RuntimeError.__init__(self, message)
+
+        self.status = status
+
+        return
+
+def parse_count(value, default):
+    """Return the string `value` as a non-negative integer, or `default` if it is not one.
+    """
+
+    try:
+        return max(int(value), 0)
+
+    except (TypeError, ValueError):
+
+        return default
+
+class BodyReader:
+    """Read a request body of known length in chunks.
+    """
+
+    def __init__(self, rfile, length):
+
+        self.rfile = rfile
+
+        self.remaining = length
+
+        return
+
+    def read(self):
+        """Return the next chunk of the body, or b"" at its end.
+        """
+
+        if not self.remaining:
+
+            return b""
+
+        chunk = self.rfile.read(min(READ_CHUNK_BYTES, self.remaining))
+
+        if not chunk:
+
+            raise RequestBodyError(400, "Request body ended prematurely")
+
+        self.remaining -= len(chunk)
+
+        return chunk
+
+    def drain(self):
+        """Read and discard the rest of the body.
+        """
+
+        while self.read():
+
+            pass
+
+        return
+
+def parse_urlencoded(reader, arguments):
+    """Parse an application/x-www-form-urlencoded body from `reader` into `arguments`, keeping the first value of each field.
+    """
+
+    def add_field(field):
+
+        if field:
+
+            name, separator, value = field.partition(b"=")
+
+            name = urllib.parse.unquote_to_bytes(name.replace(b"+", b" ")).decode("utf8", "replace")
+
+            value = urllib.parse.unquote_to_bytes(value.replace(b"+", b" ")).decode("utf8", "replace")
+
+            arguments.setdefault(name, value)
+
+        return
+
+    # Pieces of the current field, which may span several chunks
+    #
+    pending = []
+
+    pending_bytes = 0
+
+    chunk = reader.read()
+
+    while chunk:
+
+        fields = chunk.split(b"&")
+
+        for field in fields[:-1]:
+
+            pending.append(field)
+
+            add_field(b"".join(pending))
+
+            pending = []
+
+            pending_bytes = 0
+
+        pending.append(fields[-1])
+
+        pending_bytes += len(fields[-1])
+
+        if pending_bytes > MAX_FIELD_BYTES:
+
+            raise RequestBodyError(413, "Form field too large")
+
+        chunk = reader.read()
+
+    add_field(b"".join(pending))
+
+    return
+
+def parse_multipart(reader, boundary, arguments):
+    """Parse a multipart/form-data body from `reader` into `arguments`, keeping the first value of each field.
+
+       File fields are stored as bytes, other fields as strings.
+    """
+
+    delimiter = b"\r\n--" + boundary.encode("latin-1")
+
+    # Prepend a line break, so that the first delimiter looks like all
+    # others.
+    #
+    buffer = bytearray(b"\r\n")
+
+    def fill():
+
+        chunk = reader.read()
+
+        if not chunk:
+
+            raise RequestBodyError(400, "Multipart body ended prematurely")
+
+        buffer.extend(chunk)
+
+        return
+
+    def read_until_delimiter(pieces):
+        """Move the bytes before the next delimiter from the buffer to `pieces`, and remove the delimiter.
+        """
+
+        size = 0
+
+        while True:
+
+            index = buffer.find(delimiter)
+
+            if index >= 0:
+
+                pieces.append(bytes(buffer[:index]))
+
+                del buffer[:index + len(delimiter)]
+
+                return
+
+            # The end of the buffer may hold the start of a delimiter
+            #
+            keep = len(delimiter) - 1
+
+            if len(buffer) > keep:
+
+                size += len(buffer) - keep
+
+                if size > MAX_FIELD_BYTES:
+
+                    raise RequestBodyError(413, "Form field too large")
+
+                pieces.append(bytes(buffer[:-keep]))
+
+                del buffer[:-keep]
+
+            fill()
+
+    # Skip the preamble
+    #
+    read_until_delimiter([])
+
+    while True:
+
+        while len(buffer) < 2:
+
+            fill()
+
+        if buffer[:2] == b"--":
+
+            # Closing delimiter
+            #
+            break
+
+        if buffer[:2] != b"\r\n":
+
+            raise RequestBodyError(400, "Malformed multipart delimiter")
+
+        del buffer[:2]
+
+        index = buffer.find(b"\r\n\r\n")
+
+        while index < 0:
+
+            if len(buffer) > MAX_PART_HEADER_BYTES:
+
+                raise RequestBodyError(400, "Multipart headers too large")
+
+            fill()
+
+            index = buffer.find(b"\r\n\r\n")
+
+        part_headers = email.message.Message()
+
+        for line in bytes(buffer[:index]).decode("utf8", "replace").split("\r\n"):
+
+            name, separator, value = line.partition(":")
+
+            part_headers[name.strip()] = value.strip()
+
+        del buffer[:index + 4]
+
+        pieces = []
+
+        read_until_delimiter(pieces)
+
+        name = part_headers.get_param("name", header = "content-disposition")
+
+        if name is not None:
+
+            value = b"".join(pieces)
+
+            if part_headers.get_filename() is None:
+
+                value = value.decode("utf8", "replace")
+
+            arguments.setdefault(name, value)
+
+    reader.drain()
+
+    return
+
 def exposed(func):
     """Register func by its name in PycmsWebAdminHandler.uri_handlers, mapping the '/funcname' to handle it.
 
@@ -65,13 +333,16 @@ def exposed(func):
 
     URI_HANDLERS[uri] = func
 
-    stderr.write("Registering URI '{}'\n".format(uri))
+    LOGGER.debug("Registering URI '%s'", uri)
 
     return func
 
-class PycmsWebAdminHandler(http.server.BaseHTTPRequestHandler):
+class PycmsWebAdminHandler(pycms.server.InstrumentedHandlerMixin, http.server.BaseHTTPRequestHandler):
     """Request handler to display and manage the pycms web admin interface.
 
+       Requests are instrumented as described in
+       pycms.server.InstrumentedHandlerMixin.
+
        Attributes:
 
        PycmsWebAdminHandler.uri_handlers
@@ -79,10 +350,22 @@ class PycmsWebAdminHandler(http.server.BaseHTTPRequestHandler):
            exposed() decorator.
     """
 
+    # Support keep-alive
+    #
+    protocol_version = "HTTP/1.1"
+
+    timeout = pycms.server.KEEP_ALIVE_TIMEOUT
+
+    disable_nagle_algorithm = True
+
     def do_GET(self):
         """BaseHTTPRequestHandler standard method: handle a GET request.
         """
 
+        if self.send_metrics(head_only = False):
+
+            return
+
         self.parse_and_handle()
 
         return
@@ -95,68 +378,135 @@ class PycmsWebAdminHandler(http.server.BaseHTTPRequestHandler):
         
         return
 
-    def parse_and_handle(self):
-        
-        parsed_uri = urllib.parse.urlparse(self.path)
-        parsed_query = urllib.parse.parse_qs(parsed_uri.query)
+    def parse_body(self, arguments):
+        """Parse the request body into the dict `arguments`, reading it in chunks.
+        """
 
-        stderr.write("urlparse == {}\n".format(parsed_uri))
+        if "transfer-encoding" in self.headers:
 
-        stderr.write("query == {}\n".format(parsed_query))
+            raise RequestBodyError(411, "Chunked request bodies are not supported")
 
-        # Simulate CGI
-        #
-        environment = {"REQUEST_METHOD": self.command,
-                       "QUERY_STRING": parsed_uri.query}
+        try:
+            length = int(self.headers.get("content-length", 0))
+
+        except ValueError:
+
+            raise RequestBodyError(400, "Invalid Content-Length")
+
+        if length < 0:
+
+            raise RequestBodyError(400, "Invalid Content-Length")
+
+        if length > MAX_BODY_BYTES:
+
+            raise RequestBodyError(413, "Request body too large")
+
+        reader = BodyReader(self.rfile, length)
+
+        content_type = email.message.Message()
+
+        content_type["content-type"] = self.headers.get("content-type", "application/x-www-form-urlencoded")
+
+        if content_type.get_content_type() == "multipart/form-data":
+
+            boundary = content_type.get_param("boundary")
 
-        if "content-length" in self.headers:
+            if not boundary:
 
-            environment["CONTENT_LENGTH"] = self.headers["content-length"]
+                raise RequestBodyError(400, "Multipart boundary missing")
 
-        if "content-type" in self.headers:
+            parse_multipart(reader, boundary, arguments)
 
-            environment["CONTENT_TYPE"] = self.headers["content-type"]
+        elif content_type.get_content_type() == "application/x-www-form-urlencoded":
+
+            parse_urlencoded(reader, arguments)
 
         else:
 
-            # Force cgi module to parse query string
+            # Skip unknown bodies, so the connection can be reused
             #
-            environment["CONTENT_TYPE"] = "application/x-www-form-urlencoded"
+            reader.drain()
 
-            self.headers["Content-type"] = "application/x-www-form-urlencoded"
+        return
 
-        fieldstorage = cgi.FieldStorage(fp = self.rfile, headers = self.headers, environ = environment)
+    def send_content(self, status, content_type, content):
+        """Send a complete response with the string `content` as body.
+        """
 
-        arguments = {}
+        body = content.encode("utf8")
+
+        self.send_response(status)
+
+        self.send_header("Content-type", content_type)
+
+        self.send_header("Content-Length", str(len(body)))
 
-        for key in fieldstorage.keys():
+        if self.close_connection:
 
-            arguments[key] = fieldstorage.getfirst(key)
+            self.send_header("Connection", "close")
 
-        stderr.write("arguments == {}".format(arguments))
-            
-        content = ""
+        self.end_headers()
+
+        self.wfile.write(body)
+
+        return
+
+    def parse_and_handle(self):
         
+        parsed_uri = urllib.parse.urlparse(self.path)
+
+        arguments = {}
+
         try:
-            content = URI_HANDLERS[parsed_uri.path](self, **arguments)
+            self.parse_body(arguments)
+
+        except RequestBodyError as error:
+
+            # The rest of the body has not been read
+            #
+            self.close_connection = True
+
+            self.send_content(error.status, "text/plain; charset=utf-8", "Error {}: {}".format(error.status, error))
+
+            return
+
+        for key, value in urllib.parse.parse_qsl(parsed_uri.query):
+
+            arguments.setdefault(key, value)
+
+        if parsed_uri.path not in URI_HANDLERS:
+
+            self.send_content(404, "text/plain; charset=utf-8", "Error 404: '{}' not found".format(parsed_uri.path))
+
+            return
+
+        try:
+            with INSTANCE_LOCK:
+
+                content = URI_HANDLERS[parsed_uri.path](self, **arguments)
 
-            self.wfile.write("HTTP/1.1 200 OK\nContent-type: text/html\n\n".encode("utf8"))
+        except Exception as error:
 
-            self.wfile.write(content.encode("utf8"))
+            LOGGER.exception("Error handling '%s'", parsed_uri.path)
 
-        except KeyError:
+            self.send_content(500, "text/plain; charset=utf-8", "Error 500: {}".format(error))
 
-            self.wfile.write("HTTP/1.1 404 NOT FOUND\nContent-type: text/plain\n\n".encode("utf8"))
+            return
 
-            self.wfile.write("Error 404: '{}' not found".format(parsed_uri.path).encode("utf8"))
+        self.send_content(200, "text/html; charset=utf-8", content)
 
         return
 
     @exposed
-    def admin(self, **kwargs):
-        """Render the admin landing page
+    def admin(self, offset = None, limit = None, prefix = "", template = None, **kwargs):
+        """Render the admin landing page, with one page of the URI list.
         """
 
+        # quickhtml is imported by the handlers rendering pages, so that
+        # the request handling can be used without it
+        #
+        import quickhtml
+
         page = quickhtml.Page("pycms Web Admin")
 
         page.append("<h1>pycms Web Admin</h1>")
@@ -169,44 +519,89 @@ class PycmsWebAdminHandler(http.server.BaseHTTPRequestHandler):
 
         form.add_input(label = "URI:", type = "text", name = "uri")
 
-        # TODO: Taken from pycmscmd.completedefault()
-        # TODO: A template file list really should be available in the instance.
-        #
-        template_paths = glob.glob("{}/_templates/*.html".format(INSTANCE[0].htmlroot))
+        form.add_drop_down_list(label = "Template:", name = "template", list = INSTANCE[0].templates.names())
+
+        page.append(str(form))
+
+        page.append("<h2>URI List</h2>")
 
-        template_paths = [os.path.basename(path) for path in template_paths]
+        offset = parse_count(offset, 0)
 
-        form.add_drop_down_list(label = "Template:", name = "template", list = template_paths)
+        limit = min(max(parse_count(limit, ADMIN_PAGE_SIZE), 1), ADMIN_MAX_PAGE_SIZE)
+
+        template = template or None
+
+        form = quickhtml.Form(action = "/admin", method = "GET", separator = "<br>", submit_label = "Filter")
+
+        form.add_fieldset("Filter URIs")
+
+        form.add_input(label = "URI prefix:", type = "text", name = "prefix")
+
+        form.add_drop_down_list(label = "Template:", name = "template", list = [""] + INSTANCE[0].uri_map.templates())
+
+        form.add_hidden("limit", str(limit))
 
         page.append(str(form))
 
-        page.append("<h2>URI List</h2>")
-        
-        # TODO: Taken from Instance.create_page. Instead, the instance should provide a method to get the list.
+        total, items = INSTANCE[0].uri_map.list_items(prefix = prefix,
+                                                      template = template,
+                                                      offset = offset,
+                                                      limit = limit)
 
-        uri_map_dict = {}
+        # An offset past the end, e.g. after pages have been removed,
+        # leaves the listing empty, with a link back to its last page.
+        #
+        offset = min(offset, total)
 
-        with open(os.path.join(INSTANCE[0].htmlroot, '_uri_template_map.json'), "rt", encoding = "utf8") as uri_map_file:
+        if items:
 
-            uri_map_dict = json.loads(uri_map_file.read())
+            page.append("<p>Showing {} to {} of {} page(s)</p>".format(offset + 1,
+                                                                        offset + len(items),
+                                                                        total))
 
-        uris = list(uri_map_dict.keys())
+        else:
 
-        uris.sort()
+            page.append("<p>No pages to show, {} page(s) in total</p>".format(total))
 
         page.append("<ul>")
 
-        for uri in uris:
+        for uri, uri_template in items:
 
-            page.append("<li>{0} [{1}]</li>".format(uri, uri_map_dict[uri]))
+            page.append("<li>{0} [{1}]</li>".format(html.escape(uri), html.escape(uri_template)))
 
         page.append("</ul>")
 
+        def link(label, link_offset):
+
+            query = {"offset": link_offset, "limit": limit, "prefix": prefix}
+
+            if template is not None:
+
+                query["template"] = template
+
+            return '<a href="/admin?{}">{}</a>'.format(html.escape(urllib.parse.urlencode(query)), label)
+
+        links = []
+
+        if offset > 0:
+
+            links.append(link("Previous", max(offset - limit, 0)))
+
+        if offset + limit < total:
+
+            links.append(link("Next", offset + limit))
+
+        if links:
+
+            page.append("<p>{}</p>".format(" | ".join(links)))
+
         return str(page)
         
     @exposed
     def edit_template(self, uri = None, template = None,  **kwargs):
         
+        import quickhtml
+
         page = quickhtml.Page("pycms Web Admin")
 
         page.append("<h1>Create '{}'</h1>".format(uri))
@@ -234,13 +629,15 @@ class PycmsWebAdminHandler(http.server.BaseHTTPRequestHandler):
     @exposed
     def save(self, page_content = None, uri = None, template = None, **kwargs):
         
+        import quickhtml
+
         page = quickhtml.Page("pycms Web Admin")
 
         page.append("<h1>Saving '{}'</h1>".format(uri))
 
         page.append("<p>Creating page ...")
 
-        stderr.write("WARNING: TODO: Writing using unchecked parameters\n")
+        LOGGER.warning("TODO: Writing using unchecked parameters")
         
         INSTANCE[0].create_page(uri, template)
 
@@ -248,17 +645,7 @@ class PycmsWebAdminHandler(http.server.BaseHTTPRequestHandler):
         
         page.append("<p>Saving edited template as page ...")
 
-        components = uri.strip("/").split("/")
-
-        path = [INSTANCE[0].htmlroot]
-
-        path += components
-
-        path_with_index = path + ["index.html"]
-        
-        with open(os.path.join(*path_with_index), "wt", encoding = "utf8") as f:
-
-            f.write(page_content)
+        INSTANCE[0].write_page(uri, page_content)
 
         page.append(" done.</p>")
         
@@ -279,6 +666,18 @@ def main():
                       default = 8001,
                       help = "The port to listen on. Default: 8001")
 
+    parser.add_option("-t", "--threads",
+                      action = "store",
+                      type = "int",
+                      default = 10,
+                      help = "The number of worker threads to start. Default: 10")
+
+    parser.add_option("-l", "--log",
+                      action = "store_true",
+                      dest = "log",
+                      default = False,
+                      help = "Log every request. Default: Off.")
+
     options, args = parser.parse_args()
 
     if not len(args):
@@ -289,11 +688,21 @@ def main():
 
     INSTANCE[0] = pycms.Instance(args[0])
 
-    stderr.write("Created instance with htmlroot == '{}'\n".format(INSTANCE[0].htmlroot))
+    logging.basicConfig(format = "%(message)s", level = logging.INFO)
+
+    if not options.log:
+
+        logging.getLogger("pycms.access").setLevel(logging.WARNING)
+
+    LOGGER.info("Created instance with htmlroot == '%s'", INSTANCE[0].htmlroot)
 
-    server = socketserver.TCPServer(("", options.port), PycmsWebAdminHandler)
+    server = pycms.server.ThreadPoolHTTPServer(("", options.port),
+                                               PycmsWebAdminHandler,
+                                               INSTANCE[0].htmlroot,
+                                               threads = options.threads,
+                                               metrics_path = METRICS_PATH)
 
-    stderr.write("Serving at port {}\n".format(options.port))
+    LOGGER.info("Serving at port %s, metrics under %s", options.port, METRICS_PATH)
     
     server.serve_forever()
 